@@ -1,32 +1,187 @@
 import asyncio
+import cProfile
+import csv
+import functools
+import gzip
+import hashlib
+import heapq
+import html
+import io
+import json
 import logging
+import multiprocessing
 import sqlite3
 import os
+import pstats
+import re
+import string
+import sys
+import tempfile
+import threading
 import time
+import traceback
+import tracemalloc
 import uuid
+import weakref
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from difflib import SequenceMatcher
+from types import MappingProxyType
 import pandas as pd
-from aiogram import Bot, Dispatcher, BaseMiddleware
+from aiogram import Bot, Dispatcher, BaseMiddleware, F
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import FSInputFile, Message, BotCommand, BotCommandScopeChat, TelegramObject
+from aiogram.types import (BufferedInputFile, FSInputFile, Message, BotCommand, BotCommandScopeChat, TelegramObject, CallbackQuery,
+                           InlineKeyboardMarkup, InlineKeyboardButton, InlineQuery, InlineQueryResultArticle,
+                           InputTextMessageContent)
 from typing import Callable, Dict, Any, Awaitable
 from dotenv import load_dotenv
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+try:
+    import matplotlib
+except ImportError:
+    matplotlib = None
+
 load_dotenv()
 
 API_TOKEN = os.getenv('API_TOKEN')
 SUPERADMIN_ID = int(os.getenv('SUPERADMIN_ID'))
 DB_NAME = 'arbitrage_base.db'
-
-BOT_CONFIG = {
-    "log_chat_id": 0
+DB_BACKEND = os.getenv('DB_BACKEND', 'sqlite')
+DATABASE_URL = os.getenv('DATABASE_URL')
+PG_POOL_MIN_SIZE = 2
+PG_POOL_MAX_SIZE = 10
+PG_FUZZY_THRESHOLD = 0.3
+USE_MEMORY_INDEX = os.getenv('MEMORY_INDEX', '0') == '1'
+DB_TIMEOUT = 30
+
+DB_WRITE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+DB_READ_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix='db-reader')
+CHART_EXECUTOR = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+
+SCHEDULE_SETTINGS = {
+    'job_invite_cleanup': '0 * * * *',
+    'job_db_maintenance': '30 4 * * *',
+    'job_daily_export': '0 9 * * *',
+    'job_history_compaction': '15 4 * * *',
+    'job_offer_archiving': '45 4 * * *',
 }
+SETTINGS_POLL_INTERVAL = 5
+
+OFFER_FIELDS = ['pp_name', 'offer_name', 'geo', 'rate', 'details']
+WATCH_FIELDS = ['pp_name', 'offer_name', 'geo']
+WATCH_LIMIT = 20
+WATCH_DIGEST_BATCH = 5
+WATCH_DIGEST_LIMIT = 100
+WATCH_DIGESTS = {}
+WATCH_DIGEST_SKIPPED = Counter()
+
+TIER_COLUMNS = 'id, pp_name, offer_name, geo, rate, details, is_active, added_by'
+ARCHIVE_COLUMNS = 'id, pp_name, offer_name, geo, rate, details, is_active, created_at, added_by, dedup_key, archived_at'
+ARCHIVE_BATCH_SIZE = 500
+HISTORY_VIEW_LIMIT = 15
+
+STATS_TOP_LIMIT = 10
+STATS_DAYS = 14
+STATS_UPSERT_SQL = ('INSERT INTO offer_stats (dim, key, value) VALUES (?, ?, ?) '
+                    'ON CONFLICT (dim, key) DO UPDATE SET value = offer_stats.value + excluded.value')
+
+METRICS = {}
+METRICS_LOCK = threading.Lock()
+
+PROFILE_DEFAULT_SECONDS = 10
+PROFILE_MAX_SECONDS = 120
+PROFILE_TOP = 30
+TRACEMALLOC_FRAMES = 10
+LOOP_LAG_INTERVAL = 0.1
+PROFILE_LOCK = asyncio.Lock()
+
+WATCHDOG_INTERVAL = 0.25
+WATCHDOG_STACK_LIMIT = 3000
+LOOP_WATCHDOG = {'thread_id': None, 'heartbeat': 0.0}
+ACTIVE_HANDLERS = {}
+
+SEND_QUEUE = asyncio.Queue()
+SEND_QUEUE_INTERVAL = 0.05
+
+OUTBOX_BATCH_SIZE = 20
+OUTBOX_POLL_INTERVAL = 1.0
+OUTBOX_LEASE_SECONDS = 120
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BACKOFF_BASE = 5
+OUTBOX_BACKOFF_MAX = 3600
+OUTBOX_RETENTION_DAYS = 7
+OUTBOX_INSERT_SQL = 'INSERT INTO outbox (idem_key, chat_id, text) VALUES (?, ?, ?) ON CONFLICT (idem_key) DO NOTHING'
+MENU_HASHES = {}
+
+PENDING_ADDS = {}
+PENDING_ADD_TTL = 3600
+
+OFFERS_VERSION = 0
+EXPORT_CACHE = {}
+EXPORT_CACHE_LIMIT = 100
+SINGLE_FLIGHTS = {}
 
 ROLE_USER = 'user'
 ROLE_MANAGER = 'manager'
 ROLE_ADMIN = 'admin'
 ROLE_SUPERADMIN = 'superadmin'
 ROLE_BANNED = 'banned'
+ALL_ROLES = [ROLE_USER, ROLE_MANAGER, ROLE_ADMIN, ROLE_SUPERADMIN, ROLE_BANNED]
+
+USERS_PAGE_SIZE = 20
+MY_OFFERS_PAGE_SIZE = 30
+MESSAGE_LIMIT = 4096
+MESSAGE_ENTITY_LIMIT = 100
+CARD_SEPARATOR = "\n\n➖➖➖➖➖➖➖\n\n"
+HTML_TAG_RE = re.compile(r"<(/?)(\w+)[^>]*>")
+HTML_TOKEN_RE = re.compile(r"<[^>]*>|&#?\w+;|[^<&]+|[<&]")
+
+THROTTLE_RULES = {
+    'check': (10, 1 / 3),
+    'search': (10, 1 / 3),
+    'check_archive': (5, 1 / 10),
+    'inline': (20, 1),
+    'export': (3, 1 / 60),
+    'export_archive': (2, 1 / 120),
+    'my_offers': (10, 1 / 5),
+    'history': (10, 1 / 5),
+    'watch': (5, 1 / 10),
+    'watch_notify': (10, 1 / 60),
+    'stats': (5, 1 / 30),
+    'watchdog_report': (3, 1 / 300),
+}
+ROLE_THROTTLE_MULTIPLIER = {ROLE_USER: 1, ROLE_MANAGER: 2, ROLE_ADMIN: 4, ROLE_SUPERADMIN: None}
+EXPORT_COMMANDS = {'export', 'export_archive'}
+SINGLE_FLIGHT_COMMANDS = {'check', 'search', 'check_archive', 'export', 'export_archive'}
+MAX_CONCURRENT_EXPORTS = 1
+THROTTLE_BUCKETS = {}
+THROTTLE_BUCKETS_LIMIT = 10000
+IN_FLIGHT = {}
+
+EXPORT_FORMATS = {
+    'xlsx': '.xlsx',
+    'csv': '.csv',
+    'csvgz': '.csv.gz',
+    'parquet': '.parquet',
+    'jsonl': '.jsonl',
+}
+EXPORT_COLUMNS = ['id', 'pp_name', 'offer_name', 'geo', 'rate', 'details', 'is_active', 'added_by', 'username']
+EXPORT_BATCH_SIZE = 1000
 
 logging.basicConfig(level=logging.INFO)
 bot = Bot(token=API_TOKEN)
@@ -49,6 +204,156 @@ GEO_SYNONYMS = [
     {'in', 'india', 'индия'}, {'global', 'ww', 'мир', 'весь мир'}
 ]
 
+TRANSLIT_MAP = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh', 'з': 'z', 'и': 'i',
+    'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't',
+    'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'c', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch', 'ъ': '', 'ы': 'y', 'ь': '',
+    'э': 'e', 'ю': 'yu', 'я': 'ya'
+})
+WORD_RE = re.compile(r"\w+")
+ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+SCORE_PP_NAME = (100, 60, 30)
+SCORE_OFFER_NAME = (50, 30, 15)
+SCORE_GEO_SYNONYM = (40, 40, 40)
+SCORE_GEO = (10, 5, 3)
+SEARCH_LIMIT_VIEW = 20
+
+FUZZY_CANDIDATES = 200
+FUZZY_MIN_SCORE = 0.6
+
+# key -> (kind, default, editable via /config). Values are parsed once on load/write, so readers
+# get typed values straight from the BOT_CONFIG snapshot without touching the DB.
+SETTINGS_SCHEMA = {
+    'settings_version': ('int', 0, False),
+    'log_chat_id': ('int', 0, False),
+    'menu_defs_hash': ('str', '', False),
+    'invite_ttl_days': ('int', 7, True),
+    'history_retention_days': ('int', 180, True),
+    'archive_after_days': ('int', 30, True),
+    'slow_handler_ms': ('int', 2000, True),
+    'loop_stall_ms': ('int', 1000, True),
+    'search_limit': ('size', SEARCH_LIMIT_VIEW, True),
+    'my_offers_page_size': ('size', MY_OFFERS_PAGE_SIZE, True),
+    'users_page_size': ('size', USERS_PAGE_SIZE, True),
+    'watch_limit': ('size', WATCH_LIMIT, True),
+    'stats_top': ('size', STATS_TOP_LIMIT, True),
+    'stats_days': ('size', STATS_DAYS, True),
+    'max_concurrent_exports': ('size', MAX_CONCURRENT_EXPORTS, True),
+}
+SETTINGS_SCHEMA.update({name: ('cron', spec, True) for name, spec in SCHEDULE_SETTINGS.items()})
+SETTINGS_SCHEMA.update({f"throttle_{command}": ('rate', rule, True) for command, rule in THROTTLE_RULES.items()})
+EDITABLE_SETTINGS = [key for key, (_, _, editable) in SETTINGS_SCHEMA.items() if editable]
+SETTING_HINTS = {
+    'cron': "cron: <code>мин час день месяц день_недели</code> или <code>off</code>",
+    'rate': "лимит: <code>10/3</code> — 10 запросов подряд, затем 1 раз в 3 сек",
+    'size': "целое число больше 0",
+    'int': "целое число",
+}
+
+BOT_CONFIG = MappingProxyType({key: default for key, (_, default, _) in SETTINGS_SCHEMA.items()})
+
+
+def connect_db(readonly=False):
+    if readonly:
+        conn = sqlite3.connect(f"file:{os.path.abspath(DB_NAME)}?mode=ro", uri=True, timeout=DB_TIMEOUT)
+    else:
+        conn = sqlite3.connect(DB_NAME, timeout=DB_TIMEOUT)
+        conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+async def db_write(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(DB_WRITE_EXECUTOR, functools.partial(fn, *args, **kwargs))
+
+
+async def db_read(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(DB_READ_EXECUTOR, functools.partial(fn, *args, **kwargs))
+
+
+def metric_inc(name, value=1):
+    with METRICS_LOCK:
+        METRICS[name] = METRICS.get(name, 0) + value
+
+
+def metric_observe(name, seconds):
+    with METRICS_LOCK:
+        stat = METRICS.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0})
+        stat['count'] += 1
+        stat['total'] += seconds
+        stat['last'] = seconds
+        stat['max'] = max(stat['max'], seconds)
+
+
+def metrics_snapshot():
+    with METRICS_LOCK:
+        return {name: dict(value) if isinstance(value, dict) else value for name, value in METRICS.items()}
+
+
+async def reload_settings():
+    try:
+        apply_settings(await STORAGE.load_settings())
+    except Exception as e:
+        logging.error(f"Settings Reload Error: {e}")
+
+
+async def set_setting(key, value):
+    value = parse_setting(key, value)
+    version = await STORAGE.set_setting(key, format_setting(key, value))
+    if version == BOT_CONFIG['settings_version'] + 1:
+        apply_settings([(key, value), ('settings_version', version)], base=BOT_CONFIG)
+    else:
+        await reload_settings()
+
+
+async def settings_watcher():
+    while True:
+        await asyncio.sleep(SETTINGS_POLL_INTERVAL)
+        try:
+            if await STORAGE.get_settings_version() != BOT_CONFIG['settings_version']:
+                await reload_settings()
+                metric_inc('settings_reloaded')
+        except Exception as e:
+            logging.error(f"Settings Watch Error: {e}")
+
+
+def normalize_query_key(query):
+    return " ".join(query.translate(ASCII_LOWER).split()) if query else None
+
+
+async def run_single_flight(name, key, factory):
+    flight_key = (name, key)
+    while flight_key in SINGLE_FLIGHTS:
+        flight = SINGLE_FLIGHTS[flight_key]
+        metric_inc(f"{name}_coalesced")
+        try:
+            return await asyncio.shield(flight), False
+        except asyncio.CancelledError:
+            if not flight.cancelled():
+                raise
+            metric_inc(f"{name}_takeover")
+
+    flight = asyncio.get_running_loop().create_future()
+    flight.add_done_callback(lambda f: f.cancelled() or f.exception())
+    SINGLE_FLIGHTS[flight_key] = flight
+    try:
+        result = await factory()
+        flight.set_result(result)
+        return result, True
+    except asyncio.CancelledError:
+        flight.cancel()
+        raise
+    except BaseException as e:
+        flight.set_exception(e)
+        raise
+    finally:
+        SINGLE_FLIGHTS.pop(flight_key, None)
+
+
+def bump_offers_version():
+    global OFFERS_VERSION
+    OFFERS_VERSION += 1
+
 
 def normalize_geo(geo_input: str) -> str:
     key = geo_input.strip().upper()
@@ -62,9 +367,114 @@ def get_search_variations(word: str) -> list:
     return [word]
 
 
+def fold_text(text) -> str:
+    return str(text or "").lower().translate(TRANSLIT_MAP)
+
+
+def split_words(text) -> list:
+    return WORD_RE.findall(fold_text(text))
+
+
+def extract_trigrams(text) -> set:
+    trigrams = set()
+    for word in split_words(text):
+        padded = f"  {word} "
+        for i in range(len(padded) - 2):
+            trigrams.add(padded[i:i + 3])
+    return trigrams
+
+
+def word_similarity(a: str, b: str) -> float:
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def canonical_geo(geo) -> str:
+    words = WORD_RE.findall(str(geo or "").lower())
+    for group in GEO_SYNONYMS:
+        if any(w in group for w in words) or " ".join(words) in group:
+            return min(group, key=len)
+    return " ".join(split_words(geo))
+
+
+def make_dedup_key(pp_name, offer_name, geo) -> str:
+    return f"{' '.join(split_words(pp_name))}|{' '.join(split_words(offer_name))}|{canonical_geo(geo)}"
+
+
+def backfill_dedup_keys(conn):
+    while True:
+        rows = conn.execute('SELECT id, pp_name, offer_name, geo FROM offers WHERE dedup_key IS NULL LIMIT ?',
+                            (EXPORT_BATCH_SIZE,)).fetchall()
+        if not rows: break
+        conn.executemany('UPDATE offers SET dedup_key = ? WHERE id = ?',
+                         [(make_dedup_key(pp, off, geo), oid) for oid, pp, off, geo in rows])
+
+
+def index_offer_trigrams(conn, offer_id, pp_name, offer_name):
+    conn.execute('DELETE FROM offer_trgm WHERE offer_id = ?', (offer_id,))
+    trigrams = extract_trigrams(pp_name) | extract_trigrams(offer_name)
+    conn.executemany('INSERT OR IGNORE INTO offer_trgm (trgm, offer_id) VALUES (?, ?)',
+                     [(t, offer_id) for t in trigrams])
+
+
+def rebuild_trigram_index(conn):
+    conn.execute('DELETE FROM offer_trgm')
+    cursor = conn.execute('SELECT id, pp_name, offer_name FROM offers '
+                          'UNION ALL SELECT id, pp_name, offer_name FROM offers_archive')
+    while True:
+        batch = cursor.fetchmany(EXPORT_BATCH_SIZE)
+        if not batch: break
+        pairs = []
+        for oid, pp_name, offer_name in batch:
+            pairs.extend((t, oid) for t in extract_trigrams(pp_name) | extract_trigrams(offer_name))
+        conn.executemany('INSERT OR IGNORE INTO offer_trgm (trgm, offer_id) VALUES (?, ?)', pairs)
+
+
+def offer_stats_deltas(old=None, new=None, added_by=None, created_day=None):
+    deltas = Counter()
+    for data, sign in ((old, -1), (new, 1)):
+        if data:
+            deltas[('total', 'active')] += sign
+            deltas[('geo', canonical_geo(data.get('geo')).upper())] += sign
+            deltas[('pp', ' '.join(split_words(data.get('pp_name'))))] += sign
+    if created_day:
+        deltas[('total', 'added')] += 1
+        deltas[('day', created_day)] += 1
+        if added_by:
+            deltas[('manager', str(added_by))] += 1
+    return deltas
+
+
+def stats_rows(deltas):
+    return [(dim, key, value) for (dim, key), value in deltas.items() if value]
+
+
+def utc_day():
+    return time.strftime('%Y-%m-%d', time.gmtime())
+
+
+def count_offer_stats(rows, totals):
+    for pp_name, geo, is_active, added_by, created_day in rows:
+        totals.update(offer_stats_deltas(new={'pp_name': pp_name, 'geo': geo} if is_active else None,
+                                         added_by=added_by, created_day=created_day))
+
+
+def rebuild_offer_stats(conn):
+    conn.execute('DELETE FROM offer_stats')
+    totals = Counter()
+    cursor = conn.execute("SELECT pp_name, geo, is_active, added_by, substr(created_at, 1, 10) FROM offers "
+                          "UNION ALL SELECT pp_name, geo, is_active, added_by, substr(created_at, 1, 10) "
+                          "FROM offers_archive")
+    while True:
+        batch = cursor.fetchmany(EXPORT_BATCH_SIZE)
+        if not batch: break
+        count_offer_stats(batch, totals)
+    conn.executemany(STATS_UPSERT_SQL, stats_rows(totals))
+
+
 def init_db():
     try:
-        conn = sqlite3.connect(DB_NAME)
+        conn = connect_db()
+        conn.execute("PRAGMA journal_mode=WAL")
         cursor = conn.cursor()
 
         cursor.execute('''CREATE TABLE IF NOT EXISTS offers (
@@ -82,6 +492,32 @@ def init_db():
             cursor.execute("ALTER TABLE offers ADD COLUMN added_by INTEGER DEFAULT NULL")
         except:
             pass
+        try:
+            cursor.execute("ALTER TABLE offers ADD COLUMN dedup_key TEXT DEFAULT NULL")
+        except:
+            pass
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_offers_dedup ON offers(dedup_key, is_active)")
+        backfill_dedup_keys(conn)
+        try:
+            cursor.execute("ALTER TABLE offers ADD COLUMN archived_at TIMESTAMP DEFAULT NULL")
+        except:
+            pass
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_offers_archived ON offers(is_active, archived_at)")
+        cursor.execute("UPDATE offers SET archived_at = CURRENT_TIMESTAMP WHERE is_active = 0 AND archived_at IS NULL")
+
+        cursor.execute('''CREATE TABLE IF NOT EXISTS offers_archive (
+            id INTEGER PRIMARY KEY,
+            pp_name TEXT,
+            offer_name TEXT,
+            geo TEXT,
+            rate TEXT,
+            details TEXT,
+            is_active BOOLEAN DEFAULT 0,
+            created_at TIMESTAMP,
+            added_by INTEGER DEFAULT NULL,
+            dedup_key TEXT DEFAULT NULL,
+            archived_at TIMESTAMP
+        )''')
 
         cursor.execute('''CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
@@ -102,46 +538,148 @@ def init_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )''')
 
-        defaults = [('log_chat_id', '0')]
-        for key, val in defaults:
-            cursor.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', (key, val))
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_role ON users(role, user_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username COLLATE NOCASE)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_offers_owner ON offers(added_by, is_active, id)")
+
+        cursor.execute('''CREATE TABLE IF NOT EXISTS offer_trgm (
+            trgm TEXT,
+            offer_id INTEGER,
+            PRIMARY KEY (trgm, offer_id)
+        ) WITHOUT ROWID''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_offer_trgm_offer ON offer_trgm(offer_id)")
+
+        if not cursor.execute('SELECT 1 FROM offer_trgm LIMIT 1').fetchone():
+            rebuild_trigram_index(conn)
+
+        cursor.execute('''CREATE TABLE IF NOT EXISTS menu_state (
+            user_id INTEGER PRIMARY KEY,
+            commands_hash TEXT
+        )''')
+
+        cursor.execute('''CREATE TABLE IF NOT EXISTS offer_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            offer_id INTEGER NOT NULL,
+            action TEXT,
+            changes TEXT,
+            user_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_offer_history_offer ON offer_history(offer_id, id)")
+
+        cursor.execute('''CREATE TABLE IF NOT EXISTS watches (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            query TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (user_id, query)
+        )''')
+
+        cursor.execute('''CREATE TABLE IF NOT EXISTS offer_stats (
+            dim TEXT,
+            key TEXT,
+            value INTEGER DEFAULT 0,
+            PRIMARY KEY (dim, key)
+        )''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_offer_stats_top ON offer_stats(dim, value)")
+
+        cursor.execute('''CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            idem_key TEXT UNIQUE,
+            chat_id INTEGER,
+            text TEXT,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL DEFAULT 0,
+            last_error TEXT,
+            done_at REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(status, next_attempt_at)")
+        if not cursor.execute('SELECT 1 FROM offer_stats LIMIT 1').fetchone():
+            rebuild_offer_stats(conn)
+
+        cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('settings_version', '0')")
 
         conn.commit()
         conn.close()
-        load_config_from_db()
     except Exception as e:
         logging.error(f"DB Error: {e}")
 
 
-def load_config_from_db():
+def parse_setting(key, raw):
+    kind = SETTINGS_SCHEMA[key][0]
+    if kind in ('int', 'size'):
+        value = int(raw)
+        if kind == 'size' and value < 1:
+            raise ValueError(f"{key} must be positive")
+        return value
+    if kind == 'cron':
+        value = str(raw).strip()
+        if value != 'off':
+            parse_cron(value)
+        return value
+    if kind == 'rate':
+        if isinstance(raw, tuple):
+            return raw
+        capacity, period = str(raw).split('/')
+        capacity, period = int(capacity), float(period)
+        if capacity < 1 or period <= 0:
+            raise ValueError(f"{key} must be capacity/seconds")
+        return capacity, 1 / period
+    return str(raw)
+
+
+def format_setting(key, value):
+    if SETTINGS_SCHEMA[key][0] == 'rate':
+        return f"{value[0]}/{1 / value[1]:g}"
+    return str(value)
+
+
+def apply_settings(rows, base=None):
     global BOT_CONFIG
-    try:
-        conn = sqlite3.connect(DB_NAME)
-        rows = conn.execute('SELECT key, value FROM settings').fetchall()
-        conn.close()
-        for key, value in rows:
-            if key in ['log_chat_id']:
-                BOT_CONFIG[key] = int(value)
-            else:
-                BOT_CONFIG[key] = value
-    except Exception as e:
-        logging.error(f"Config Error: {e}")
+    config = dict(base if base is not None else {key: spec[1] for key, spec in SETTINGS_SCHEMA.items()})
+    for key, raw in rows:
+        if key not in SETTINGS_SCHEMA:
+            continue
+        try:
+            config[key] = parse_setting(key, raw)
+        except ValueError as e:
+            logging.error(f"Setting Error ({key}={raw!r}): {e}")
+
+    if any(config[key] != BOT_CONFIG[key] for key in config if key.startswith('throttle_')):
+        THROTTLE_BUCKETS.clear()
+    BOT_CONFIG = MappingProxyType(config)
+
+
+def load_settings_db():
+    conn = connect_db(readonly=True)
+    rows = conn.execute('SELECT key, value FROM settings').fetchall()
+    conn.close()
+    return rows
+
+
+def get_settings_version_db():
+    conn = connect_db(readonly=True)
+    row = conn.execute("SELECT value FROM settings WHERE key = 'settings_version'").fetchone()
+    conn.close()
+    return int(row[0]) if row else 0
 
 
 def update_setting_db(key, value):
-    try:
-        conn = sqlite3.connect(DB_NAME)
-        conn.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, str(value)))
-        conn.commit()
-        conn.close()
-        load_config_from_db()
-    except Exception as e:
-        logging.error(f"Setting Error: {e}")
+    conn = connect_db()
+    conn.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
+    conn.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('settings_version', '0')")
+    conn.execute("UPDATE settings SET value = CAST(value AS INTEGER) + 1 WHERE key = 'settings_version'")
+    version = conn.execute("SELECT value FROM settings WHERE key = 'settings_version'").fetchone()[0]
+    conn.commit()
+    conn.close()
+    return int(version)
 
 
 def create_invite_db(role, uses):
     code = uuid.uuid4().hex[:8]
-    conn = sqlite3.connect(DB_NAME)
+    conn = connect_db()
     conn.execute('INSERT INTO invites (code, role, uses_left) VALUES (?, ?, ?)', (code, role, uses))
     conn.commit()
     conn.close()
@@ -149,7 +687,7 @@ def create_invite_db(role, uses):
 
 
 def check_and_use_invite(code):
-    conn = sqlite3.connect(DB_NAME)
+    conn = connect_db()
     cursor = conn.cursor()
 
     row = cursor.execute('SELECT role, uses_left FROM invites WHERE code = ?', (code,)).fetchone()
@@ -174,50 +712,195 @@ def check_and_use_invite(code):
     return role
 
 
+def cleanup_invites_db(ttl_days):
+    conn = connect_db()
+    if ttl_days > 0:
+        cursor = conn.execute("DELETE FROM invites WHERE uses_left <= 0 OR created_at < datetime('now', ?)",
+                              (f"-{ttl_days} days",))
+    else:
+        cursor = conn.execute("DELETE FROM invites WHERE uses_left <= 0")
+    conn.commit()
+    deleted = cursor.rowcount
+    conn.close()
+    return deleted
+
+
+def maintain_db():
+    conn = connect_db()
+    conn.execute("ANALYZE")
+    conn.execute("VACUUM")
+    conn.execute("PRAGMA optimize")
+    conn.close()
+
+
 def get_user_role(user_id):
     if user_id == SUPERADMIN_ID: return ROLE_SUPERADMIN
-    conn = sqlite3.connect(DB_NAME)
+    conn = connect_db(readonly=True)
     res = conn.execute('SELECT role FROM users WHERE user_id = ?', (user_id,)).fetchone()
     conn.close()
     return res[0] if res else None
 
 
-def add_user(user_id, username, role=ROLE_USER):
-    conn = sqlite3.connect(DB_NAME)
+def add_user(user_id, username, role=ROLE_USER, outbox=()):
+    conn = connect_db()
     conn.execute('INSERT OR IGNORE INTO users (user_id, username, role) VALUES (?, ?, ?)', (user_id, username, role))
+    write_outbox(conn, outbox)
     conn.commit()
     conn.close()
 
 
-def update_user_role(target_id, new_role):
-    conn = sqlite3.connect(DB_NAME)
+def update_user_role(target_id, new_role, outbox=()):
+    conn = connect_db()
     conn.execute('UPDATE users SET role = ? WHERE user_id = ?', (new_role, target_id))
+    write_outbox(conn, outbox)
+    conn.commit()
+    conn.close()
+
+
+def diff_offer_fields(old, new):
+    changes = {}
+    for field in OFFER_FIELDS:
+        old_value = old.get(field) if old else None
+        new_value = new.get(field)
+        if old_value != new_value:
+            changes[field] = [old_value, new_value]
+    return changes
+
+
+def record_offer_history(conn, offer_id, action, changes, user_id):
+    conn.execute(
+        'INSERT INTO offer_history (offer_id, action, changes, user_id) VALUES (?, ?, ?, ?)',
+        (offer_id, action, dump_changes(changes), user_id)
+    )
+
+
+def outbox_rows(entries):
+    return [(key or uuid.uuid4().hex, chat_id, text) for key, chat_id, text in entries]
+
+
+def write_outbox(conn, entries):
+    # entries: (idem_key, chat_id, text). Offer writes take a callable instead, since the
+    # message needs the id/row that is only known inside the transaction.
+    if entries:
+        conn.executemany(OUTBOX_INSERT_SQL, outbox_rows(entries))
+
+
+def enqueue_outbox_db(entries):
+    conn = connect_db()
+    write_outbox(conn, entries)
+    conn.commit()
+    conn.close()
+
+
+def claim_outbox_db(limit=OUTBOX_BATCH_SIZE, lease=OUTBOX_LEASE_SECONDS):
+    now = time.time()
+    conn = connect_db()
+    rows = conn.execute("SELECT id, chat_id, text, attempts FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? "
+                        "ORDER BY id LIMIT ?", (now, limit)).fetchall()
+    if rows:
+        conn.executemany('UPDATE outbox SET next_attempt_at = ? WHERE id = ?', [(now + lease, r[0]) for r in rows])
+        conn.commit()
+    conn.close()
+    return rows
+
+
+def finish_outbox_db(results):
+    conn = connect_db()
+    conn.executemany('UPDATE outbox SET status = ?, attempts = attempts + 1, next_attempt_at = ?, last_error = ?, '
+                     'done_at = ? WHERE id = ?', results)
+    conn.commit()
+    conn.close()
+
+
+def purge_outbox_db(retention_days):
+    conn = connect_db()
+    cursor = conn.execute("DELETE FROM outbox WHERE status != 'pending' AND done_at < ?",
+                          (time.time() - retention_days * 86400,))
+    conn.commit()
+    conn.close()
+    return cursor.rowcount
+
+
+def get_offer_history_db(offer_id, limit=HISTORY_VIEW_LIMIT):
+    conn = connect_db(readonly=True)
+    rows = conn.execute(
+        'SELECT action, changes, user_id, created_at FROM offer_history WHERE offer_id = ? ORDER BY id DESC LIMIT ?',
+        (offer_id, limit)
+    ).fetchall()
+    conn.close()
+    return [(action, json.loads(changes or '{}'), uid, created_at) for action, changes, uid, created_at in rows]
+
+
+def dump_changes(changes):
+    return json.dumps(changes, ensure_ascii=False, separators=(',', ':'))
+
+
+def merge_history_changes(changes_list):
+    merged = {}
+    for changes in changes_list:
+        for field, (old_value, new_value) in json.loads(changes or '{}').items():
+            merged[field] = [merged[field][0] if field in merged else old_value, new_value]
+    return dump_changes({f: v for f, v in merged.items() if v[0] != v[1]})
+
+
+def compact_offer_history_db(retention_days, batch_size=500):
+    conn = connect_db()
+    cutoff = f"-{retention_days} days"
+    offer_ids = [r[0] for r in conn.execute(
+        "SELECT offer_id FROM offer_history WHERE created_at < datetime('now', ?) "
+        "GROUP BY offer_id HAVING COUNT(*) > 1 LIMIT ?",
+        (cutoff, batch_size)
+    ).fetchall()]
+
+    removed = 0
+    for offer_id in offer_ids:
+        rows = conn.execute(
+            "SELECT id, changes FROM offer_history WHERE offer_id = ? AND created_at < datetime('now', ?) ORDER BY id",
+            (offer_id, cutoff)
+        ).fetchall()
+
+        keep_id = rows[-1][0]
+        conn.execute("UPDATE offer_history SET action = 'compact', changes = ? WHERE id = ?",
+                     (merge_history_changes(changes for _, changes in rows), keep_id))
+        conn.executemany("DELETE FROM offer_history WHERE id = ?", [(r[0],) for r in rows[:-1]])
+        removed += len(rows) - 1
+
     conn.commit()
     conn.close()
+    return removed
 
 
-def add_offer_db(data, user_id):
-    conn = sqlite3.connect(DB_NAME)
+def add_offer_db(data, user_id, outbox=None):
+    conn = connect_db()
     cursor = conn.cursor()
 
     cursor.execute(
-        'INSERT INTO offers (pp_name, offer_name, geo, rate, details, added_by) VALUES (?, ?, ?, ?, ?, ?)',
+        'INSERT INTO offers (pp_name, offer_name, geo, rate, details, added_by, dedup_key) VALUES (?, ?, ?, ?, ?, ?, ?)',
         (data['pp_name'], data['offer_name'], data.get('geo', 'Global'), data['rate'], data.get('details', '-'),
-         user_id)
+         user_id, make_dedup_key(data['pp_name'], data['offer_name'], data.get('geo', 'Global')))
     )
 
-    conn.commit()
-
     new_id = cursor.lastrowid
+    index_offer_trigrams(conn, new_id, data['pp_name'], data['offer_name'])
+    record_offer_history(conn, new_id, 'add', diff_offer_fields(None, data), user_id)
+    conn.executemany(STATS_UPSERT_SQL, stats_rows(offer_stats_deltas(new=data, added_by=user_id, created_day=utc_day())))
+    if outbox:
+        write_outbox(conn, outbox(new_id, data))
+
+    conn.commit()
 
     conn.close()
+    bump_offers_version()
+    if MEMORY_INDEX:
+        MEMORY_INDEX.upsert(new_id, data, user_id)
     return new_id
 
 
-def update_offer_db(offer_id, data, user_id, role):
-    conn = sqlite3.connect(DB_NAME)
+def update_offer_db(offer_id, data, user_id, role, outbox=None):
+    conn = connect_db()
+    check = conn.execute("SELECT added_by, pp_name, offer_name, geo, rate, details, is_active FROM offers WHERE id = ?",
+                         (offer_id,)).fetchone()
     if role == ROLE_MANAGER:
-        check = conn.execute("SELECT added_by FROM offers WHERE id = ?", (offer_id,)).fetchone()
         if not check:
             conn.close()
             return False
@@ -225,16 +908,98 @@ def update_offer_db(offer_id, data, user_id, role):
             conn.close()
             return "not_owner"
 
-    sql = 'UPDATE offers SET pp_name=?, offer_name=?, geo=?, rate=?, details=? WHERE id=?'
-    conn.execute(sql,
-                 (data['pp_name'], data['offer_name'], data.get('geo'), data['rate'], data.get('details'), offer_id))
+    sql = 'UPDATE offers SET pp_name=?, offer_name=?, geo=?, rate=?, details=?, dedup_key=? WHERE id=?'
+    cursor = conn.execute(sql, (data['pp_name'], data['offer_name'], data.get('geo'), data['rate'], data.get('details'),
+                                make_dedup_key(data['pp_name'], data['offer_name'], data.get('geo')), offer_id))
+    if not cursor.rowcount:
+        conn.close()
+        return False
+    index_offer_trigrams(conn, offer_id, data['pp_name'], data['offer_name'])
+    changes = diff_offer_fields(dict(zip(OFFER_FIELDS, check[1:6])), data)
+    if changes:
+        record_offer_history(conn, offer_id, 'edit', changes, user_id)
+    if check[6]:
+        conn.executemany(STATS_UPSERT_SQL, stats_rows(offer_stats_deltas(dict(zip(OFFER_FIELDS, check[1:6])), data)))
+    if outbox:
+        write_outbox(conn, outbox(offer_id, data))
     conn.commit()
     conn.close()
+    bump_offers_version()
+    if MEMORY_INDEX and check[6]:
+        MEMORY_INDEX.upsert(offer_id, data, check[0])
     return True
 
 
+def find_duplicate_offer_db(data, exclude_id=None):
+    key = make_dedup_key(data['pp_name'], data['offer_name'], data.get('geo', 'Global'))
+    conn = connect_db(readonly=True)
+    row = conn.execute(
+        'SELECT id, added_by FROM offers WHERE dedup_key = ? AND is_active = 1 AND id != ? ORDER BY id DESC LIMIT 1',
+        (key, exclude_id or 0)
+    ).fetchone()
+    conn.close()
+    return row
+
+
+def find_duplicate_groups_db():
+    conn = connect_db(readonly=True)
+    rows = conn.execute(
+        "SELECT dedup_key, GROUP_CONCAT(id) FROM offers WHERE is_active = 1 AND dedup_key IS NOT NULL "
+        "GROUP BY dedup_key HAVING COUNT(*) > 1"
+    ).fetchall()
+    conn.close()
+    return parse_duplicate_groups(rows)
+
+
+def parse_duplicate_groups(rows):
+    groups = []
+    for key, ids in rows:
+        ids = sorted((int(i) for i in ids.split(',')), reverse=True)
+        groups.append((key, ids[0], ids[1:]))
+    return groups
+
+
+def merge_duplicate_offers_db(user_id, outbox=None):
+    groups = find_duplicate_groups_db()
+    archived = [(dup_id, keep_id) for _, keep_id, dups in groups for dup_id in dups]
+    if not archived:
+        return 0, 0
+
+    conn = connect_db()
+    placeholders = ",".join("?" * len(archived))
+    removed = conn.execute(f"SELECT pp_name, geo FROM offers WHERE is_active = 1 AND id IN ({placeholders})",
+                           [d for d, _ in archived]).fetchall()
+    conn.executemany('UPDATE offers SET is_active = 0, archived_at = CURRENT_TIMESTAMP WHERE id = ? AND is_active = 1',
+                     [(d,) for d, _ in archived])
+    deltas = Counter()
+    for pp_name, geo in removed:
+        deltas.update(offer_stats_deltas(old={'pp_name': pp_name, 'geo': geo}))
+    conn.executemany(STATS_UPSERT_SQL, stats_rows(deltas))
+    conn.executemany(
+        'INSERT INTO offer_history (offer_id, action, changes, user_id) VALUES (?, ?, ?, ?)',
+        [(d, 'del', dump_changes({'is_active': [1, 0], 'merged_into': [None, k]}), user_id) for d, k in archived]
+    )
+    if outbox:
+        write_outbox(conn, outbox(len(groups), len(archived)))
+    conn.commit()
+    conn.close()
+    bump_offers_version()
+    if MEMORY_INDEX:
+        for dup_id, _ in archived:
+            MEMORY_INDEX.remove(dup_id)
+    return len(groups), len(archived)
+
+
+def get_active_offers_db():
+    conn = connect_db(readonly=True)
+    rows = conn.execute(
+        'SELECT id, pp_name, offer_name, geo, rate, details, added_by FROM offers WHERE is_active = 1').fetchall()
+    conn.close()
+    return rows
+
+
 def get_offer_by_id(offer_id):
-    conn = sqlite3.connect(DB_NAME)
+    conn = connect_db(readonly=True)
     row = conn.execute('SELECT pp_name, offer_name, geo, rate, details FROM offers WHERE id = ?',
                        (offer_id,)).fetchone()
     conn.close()
@@ -245,8 +1010,9 @@ def check_offer_ownership_db(offer_id, user_id, role):
     if role in [ROLE_ADMIN, ROLE_SUPERADMIN]:
         return True
 
-    conn = sqlite3.connect(DB_NAME)
-    row = conn.execute("SELECT added_by FROM offers WHERE id = ?", (offer_id,)).fetchone()
+    conn = connect_db(readonly=True)
+    row = conn.execute("SELECT added_by FROM offers WHERE id = ? UNION ALL SELECT added_by FROM offers_archive WHERE id = ?",
+                       (offer_id, offer_id)).fetchone()
     conn.close()
 
     if not row:
@@ -259,11 +1025,255 @@ def check_offer_ownership_db(offer_id, user_id, role):
     return True
 
 
-def search_offers_db(query=None, show_all=False, restrict_to_user_id=None):
-    conn = sqlite3.connect(DB_NAME)
-    sql = 'SELECT id, pp_name, offer_name, geo, rate, details, is_active FROM offers'
-    conditions = []
+class OfferRecord:
+    __slots__ = ('id', 'pp_name', 'offer_name', 'geo', 'rate', 'details', 'added_by', 'folded')
+
+    def __init__(self, oid, pp_name, offer_name, geo, rate, details, added_by):
+        self.id = oid
+        self.pp_name = pp_name
+        self.offer_name = offer_name
+        self.geo = geo
+        self.rate = rate
+        self.details = details
+        self.added_by = added_by
+        self.folded = tuple(str(v).translate(ASCII_LOWER) if v is not None else None for v in (pp_name, offer_name, geo))
+
+    def as_row(self):
+        return self.id, self.pp_name, self.offer_name, self.geo, self.rate, self.details, 1
+
+
+class OfferMemoryIndex:
+    """Active offers kept in RAM with trigram posting lists; mirrors search_offers_db ranking."""
+
+    def __init__(self):
+        self.records = {}
+        self.postings = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def grams(record):
+        grams = set()
+        for value in record.folded:
+            if value:
+                grams.update(value[i:i + 3] for i in range(len(value) - 2))
+                grams.update(value[i:i + 2] for i in range(len(value) - 1))
+        return grams
+
+    def load(self, rows):
+        with self.lock:
+            self.records.clear()
+            self.postings.clear()
+            for row in rows:
+                self._insert(OfferRecord(*row))
+        return len(self.records)
+
+    def _insert(self, record):
+        self.records[record.id] = record
+        for gram in self.grams(record):
+            self.postings.setdefault(gram, set()).add(record.id)
+
+    def _delete(self, offer_id):
+        record = self.records.pop(offer_id, None)
+        if not record: return
+        for gram in self.grams(record):
+            ids = self.postings.get(gram)
+            if ids:
+                ids.discard(offer_id)
+                if not ids: del self.postings[gram]
+
+    def upsert(self, offer_id, data, added_by):
+        record = OfferRecord(offer_id, data['pp_name'], data['offer_name'], data.get('geo', 'Global'), data['rate'],
+                             data.get('details', '-'), added_by)
+        with self.lock:
+            self._delete(offer_id)
+            self._insert(record)
+
+    def remove(self, offer_id):
+        with self.lock:
+            self._delete(offer_id)
+
+    def owner_of(self, offer_id):
+        record = self.records.get(offer_id)
+        return record.added_by if record else None
+
+    @staticmethod
+    def supports(query):
+        return not query or ('%' not in query and '_' not in query)
+
+    def _candidates(self, variations):
+        found = set()
+        for var in variations:
+            size = 3 if len(var) >= 3 else 2
+            grams = [var[i:i + size] for i in range(len(var) - size + 1)]
+            if not grams:
+                return None
+            postings = sorted((self.postings.get(g, set()) for g in grams), key=len)
+            found |= set.intersection(*postings) if postings[0] else set()
+        return found
+
+    @staticmethod
+    def _tier(value, variations, weights):
+        if value is None: return 0
+        best = 0
+        for v in variations:
+            if v in value:
+                if value == v: return weights[0]
+                if value.startswith(v):
+                    best = weights[1]
+                elif not best:
+                    best = weights[2]
+        return best
+
+    def search(self, query=None, restrict_to_user_id=None, limit=None):
+        keywords = [(w, [v.translate(ASCII_LOWER) for v in get_search_variations(w)]) for w in (query or "").split()]
+
+        if not keywords:
+            with self.lock:
+                ids = [r.id for r in self.records.values()
+                       if not restrict_to_user_id or r.added_by == restrict_to_user_id]
+                top = heapq.nlargest(limit, ids) if limit else sorted(ids, reverse=True)
+                return [self.records[i].as_row() for i in top], len(ids)
+
+        with self.lock:
+            candidate_ids = None
+            for _, variations in keywords:
+                found = self._candidates(variations)
+                if found is None: continue
+                candidate_ids = found if candidate_ids is None else candidate_ids & found
+
+            records = self.records.values() if candidate_ids is None else \
+                [self.records[i] for i in candidate_ids if i in self.records]
+
+            matched = []
+            for record in records:
+                if restrict_to_user_id and record.added_by != restrict_to_user_id:
+                    continue
+                score = 0
+                ok = True
+                for _, variations in keywords:
+                    pp_score = self._tier(record.folded[0], variations, SCORE_PP_NAME)
+                    offer_score = self._tier(record.folded[1], variations, SCORE_OFFER_NAME)
+                    geo_score = self._tier(record.folded[2], variations,
+                                           SCORE_GEO_SYNONYM if len(variations) > 1 else SCORE_GEO)
+                    if not (pp_score or offer_score or geo_score):
+                        ok = False
+                        break
+                    score += pp_score + offer_score + geo_score
+                if ok:
+                    matched.append((score, record.id, record))
+
+        if limit:
+            top = heapq.nlargest(limit, matched, key=lambda x: (x[0], x[1]))
+        else:
+            top = sorted(matched, key=lambda x: (x[0], x[1]), reverse=True)
+        return [r.as_row() for _, _, r in top], len(matched)
+
+
+MEMORY_INDEX = OfferMemoryIndex() if USE_MEMORY_INDEX else None
+
+
+class WatchIndex:
+    """Saved searches indexed by their rarest term; an offer is matched by looking up its word prefixes."""
+
+    def __init__(self):
+        self.watches = {}
+        self.postings = {}
+
+    @staticmethod
+    def terms(query):
+        terms = []
+        for word in WORD_RE.findall(query.lower()):
+            variations = {v.lower() for v in get_search_variations(word)}
+            terms.append({v for v in variations if WORD_RE.fullmatch(v)})
+        return terms
+
+    @staticmethod
+    def prefixes(data):
+        prefixes = set()
+        for field in WATCH_FIELDS:
+            for word in WORD_RE.findall(str(data.get(field) or "").lower()):
+                prefixes.update(word[:i] for i in range(1, len(word) + 1))
+        return prefixes
+
+    def load(self, rows):
+        self.watches.clear()
+        self.postings.clear()
+        for watch_id, user_id, query in rows:
+            self.add(watch_id, user_id, query)
+        return len(self.watches)
+
+    def add(self, watch_id, user_id, query):
+        terms = self.terms(query)
+        if not terms: return
+        anchor = min(terms, key=lambda variations: (sum(len(self.postings.get(v, ())) for v in variations),
+                                                    -min(len(v) for v in variations)))
+        self.watches[watch_id] = (user_id, query, terms, anchor)
+        for term in anchor:
+            self.postings.setdefault(term, set()).add(watch_id)
+
+    def remove(self, watch_id):
+        watch = self.watches.pop(watch_id, None)
+        if not watch: return
+        for term in watch[3]:
+            ids = self.postings.get(term)
+            if ids:
+                ids.discard(watch_id)
+                if not ids: del self.postings[term]
+
+    def match(self, data):
+        if not self.watches:
+            return []
+        prefixes = self.prefixes(data)
+        candidates = set()
+        for prefix in prefixes:
+            candidates |= self.postings.get(prefix, set())
+
+        matched = []
+        for watch_id in candidates:
+            user_id, query, terms, _ = self.watches[watch_id]
+            if all(variations & prefixes for variations in terms):
+                matched.append((watch_id, user_id, query))
+        return matched
+
+
+WATCH_INDEX = WatchIndex()
+
+
+def build_relevance_score(keywords):
+    terms = []
     params = []
+    for word in keywords:
+        variations = get_search_variations(word)
+        is_geo = len(variations) > 1
+
+        def tiers(column, weights):
+            parts = []
+            for pattern, weight in zip(['{}', '{}%', '%{}%'], weights):
+                parts.append(f"WHEN {' OR '.join([f'{column} LIKE ?'] * len(variations))} THEN {weight}")
+                params.extend(pattern.format(var) for var in variations)
+            return f"(CASE {' '.join(parts)} ELSE 0 END)"
+
+        terms.append(tiers('pp_name', SCORE_PP_NAME))
+        terms.append(tiers('offer_name', SCORE_OFFER_NAME))
+        terms.append(tiers('geo', SCORE_GEO_SYNONYM if is_geo else SCORE_GEO))
+
+    return (" + ".join(terms) if terms else "0"), params
+
+
+def offers_source(include_archive, alias="offers", columns=TIER_COLUMNS):
+    if not include_archive:
+        return "offers" if alias == "offers" else f"offers {alias}"
+    return f"(SELECT {columns} FROM offers UNION ALL SELECT {columns} FROM offers_archive) {alias}"
+
+
+def build_search_query(query=None, show_all=False, restrict_to_user_id=None, limit=None):
+    keywords = query.split() if query else []
+    score_sql, score_params = build_relevance_score(keywords)
+
+    sql = f'SELECT id, pp_name, offer_name, geo, rate, details, is_active, {score_sql} AS score, COUNT(*) OVER () ' \
+          f'FROM {offers_source(show_all)}'
+    conditions = []
+    params = list(score_params)
 
     if not show_all:
         conditions.append("is_active = 1")
@@ -272,22 +1282,29 @@ def search_offers_db(query=None, show_all=False, restrict_to_user_id=None):
         conditions.append("added_by = ?")
         params.append(restrict_to_user_id)
 
-    if query:
-        keywords = query.split()
-        for word in keywords:
-            variations = get_search_variations(word)
-            var_conditions = []
-            for var in variations:
-                var_conditions.append("(pp_name LIKE ? OR offer_name LIKE ? OR geo LIKE ?)")
-                params.extend([f"%{var}%", f"%{var}%", f"%{var}%"])
-            if var_conditions:
-                conditions.append(f"({' OR '.join(var_conditions)})")
+    for word in keywords:
+        variations = get_search_variations(word)
+        var_conditions = []
+        for var in variations:
+            var_conditions.append("(pp_name LIKE ? OR offer_name LIKE ? OR geo LIKE ?)")
+            params.extend([f"%{var}%", f"%{var}%", f"%{var}%"])
+        if var_conditions:
+            conditions.append(f"({' OR '.join(var_conditions)})")
 
     if conditions:
         sql += " WHERE " + " AND ".join(conditions)
 
-    sql += ' ORDER BY id DESC'
+    sql += ' ORDER BY score DESC, id DESC'
+
+    if limit:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    return sql, params
 
+
+def search_offers_db(query=None, show_all=False, restrict_to_user_id=None, limit=None):
+    sql, params = build_search_query(query, show_all, restrict_to_user_id, limit)
+    conn = connect_db(readonly=True)
     try:
         rows = conn.execute(sql, params).fetchall()
     except Exception as e:
@@ -295,33 +1312,133 @@ def search_offers_db(query=None, show_all=False, restrict_to_user_id=None):
         rows = []
 
     conn.close()
-    return rows
+    total = rows[0][8] if rows else 0
+    return [r[:7] for r in rows], total
+
+
+def build_fuzzy_filters(query, show_all=False, restrict_to_user_id=None):
+    conditions = []
+    params = []
+    fuzzy_words = []
+
+    for word in query.split():
+        variations = get_search_variations(word)
+        if len(variations) > 1:
+            conditions.append(f"({' OR '.join(['o.geo LIKE ?'] * len(variations))})")
+            params.extend(f"%{var}%" for var in variations)
+        else:
+            fuzzy_words.extend(split_words(word))
+
+    if not show_all:
+        conditions.append("o.is_active = 1")
+    if restrict_to_user_id:
+        conditions.append("o.added_by = ?")
+        params.append(restrict_to_user_id)
+    return conditions, params, fuzzy_words
+
+
+def rank_fuzzy_candidates(candidates, fuzzy_words, limit):
+    scored = []
+    best_terms = {}
+    for row in candidates:
+        row_words = split_words(row[1]) + split_words(row[2])
+        if not row_words: continue
+        total = 0.0
+        for word in fuzzy_words:
+            score, term = max((word_similarity(word, w), w) for w in row_words)
+            total += score
+            if score > best_terms.get(word, (0, None))[0]:
+                best_terms[word] = (score, term)
+        score = total / len(fuzzy_words)
+        if score >= FUZZY_MIN_SCORE:
+            scored.append((score, row))
+
+    scored.sort(key=lambda x: (-x[0], -x[1][0]))
+    suggestion = " ".join(best_terms[w][1] for w in fuzzy_words if w in best_terms) if scored else None
+    return [row for _, row in scored[:limit]], suggestion
+
+
+def fuzzy_search_offers_db(query, show_all=False, restrict_to_user_id=None, limit=20):
+    conditions, params, fuzzy_words = build_fuzzy_filters(query, show_all, restrict_to_user_id)
+    if not fuzzy_words:
+        return [], None
+
+    trigrams = set()
+    for word in fuzzy_words:
+        trigrams |= extract_trigrams(word)
+
+    where = "".join(f" AND {c}" for c in conditions)
+    placeholders = ",".join("?" * len(trigrams))
+    tiers = ["offers", "offers_archive"] if show_all else ["offers"]
+    branches = " UNION ALL ".join(
+        f"SELECT o.id, o.pp_name, o.offer_name, o.geo, o.rate, o.details, o.is_active, t.hits "
+        f"FROM t JOIN {tier} o ON o.id = t.offer_id WHERE 1 = 1{where}"
+        for tier in tiers
+    )
+    sql = f"""
+    WITH t AS (
+        SELECT offer_id, COUNT(*) AS hits FROM offer_trgm
+        WHERE trgm IN ({placeholders})
+        GROUP BY offer_id
+    )
+    {branches}
+    ORDER BY 8 DESC, 1 DESC
+    LIMIT ?
+    """
+
+    conn = connect_db(readonly=True)
+    try:
+        rows = conn.execute(sql, list(trigrams) + params * len(tiers) + [FUZZY_CANDIDATES]).fetchall()
+        candidates = [row[:7] for row in rows]
+    except Exception as e:
+        logging.error(f"Fuzzy Search Error: {e}")
+        candidates = []
+    conn.close()
+    return rank_fuzzy_candidates(candidates, fuzzy_words, limit)
+
+
+def build_my_offers_query(user_id, after_id=None, before_id=None, limit=MY_OFFERS_PAGE_SIZE):
+    sql = 'SELECT id, pp_name, offer_name, geo, rate, details FROM offers WHERE added_by = ? AND is_active = 1'
+    params = [user_id]
+    if before_id is not None:
+        sql += ' AND id > ? ORDER BY id ASC LIMIT ?'
+        params += [before_id, limit + 1]
+    elif after_id is not None:
+        sql += ' AND id < ? ORDER BY id DESC LIMIT ?'
+        params += [after_id, limit + 1]
+    else:
+        sql += ' ORDER BY id DESC LIMIT ?'
+        params.append(limit + 1)
+    return sql, params
 
 
-def get_my_offers_db(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    sql = 'SELECT id, pp_name, offer_name, geo, rate, details FROM offers WHERE added_by = ? AND is_active = 1 ORDER BY id DESC'
+def get_my_offers_page_db(user_id, after_id=None, before_id=None, limit=MY_OFFERS_PAGE_SIZE):
+    conn = connect_db(readonly=True)
     try:
-        rows = conn.execute(sql, (user_id,)).fetchall()
+        conn.execute('BEGIN')
+        total = conn.execute('SELECT COUNT(*) FROM offers WHERE added_by = ? AND is_active = 1', (user_id,)).fetchone()[0]
+        rows = conn.execute(*build_my_offers_query(user_id, after_id, before_id, limit)).fetchall()
     except Exception as e:
         logging.error(f"My Offers Error: {e}")
-        rows = []
+        rows, total = [], 0
     conn.close()
-    return rows
 
+    has_more = len(rows) > limit
+    return rows[:limit], total, has_more
 
-def delete_offer_db(offer_id, user_id, role):
-    conn = sqlite3.connect(DB_NAME)
+
+def delete_offer_db(offer_id, user_id, role, outbox=None):
+    conn = connect_db()
     row = conn.execute(
-        "SELECT pp_name, offer_name, geo, rate, details, added_by FROM offers WHERE id = ?",
+        "SELECT pp_name, offer_name, geo, rate, details, added_by, is_active FROM offers WHERE id = ?",
         (offer_id,)
     ).fetchone()
 
-    if not row:
+    if not row or not row[6]:
         conn.close()
         return False
 
-    pp_name, offer_name, geo, rate, details, owner_id = row
+    pp_name, offer_name, geo, rate, details, owner_id, _ = row
 
     offer_data = {
         'pp_name': pp_name,
@@ -336,43 +1453,231 @@ def delete_offer_db(offer_id, user_id, role):
             conn.close()
             return "not_owner"
 
-    conn.execute('UPDATE offers SET is_active = 0 WHERE id = ?', (offer_id,))
+    conn.execute('UPDATE offers SET is_active = 0, archived_at = CURRENT_TIMESTAMP WHERE id = ?', (offer_id,))
+    record_offer_history(conn, offer_id, 'del', {'is_active': [1, 0]}, user_id)
+    conn.executemany(STATS_UPSERT_SQL, stats_rows(offer_stats_deltas(old=offer_data)))
+    if outbox:
+        write_outbox(conn, outbox(offer_id, offer_data))
     conn.commit()
     conn.close()
+    bump_offers_version()
+    if MEMORY_INDEX:
+        MEMORY_INDEX.remove(offer_id)
 
     return offer_data
 
 
-def get_all_users():
-    conn = sqlite3.connect(DB_NAME)
-    df = pd.read_sql_query("SELECT user_id, username, role FROM users", conn)
-    conn.close()
-    return df
+def build_users_page_queries(role_filter=None, name_filter=None, after_id=None, before_id=None, limit=USERS_PAGE_SIZE):
+    conditions = []
+    params = []
 
+    if role_filter:
+        conditions.append("role = ?")
+        params.append(role_filter)
 
-async def update_command_menu(bot: Bot, user_id: int, role: str):
-    commands_user = [
-        BotCommand(command="check", description="🔎 Поиск"),
-        BotCommand(command="export", description="📊 Excel"),
-        BotCommand(command="help", description="ℹ️ Помощь"),
-    ]
+    if name_filter:
+        escaped = name_filter.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        conditions.append("username LIKE ? ESCAPE '\\'")
+        params.append(f"{escaped}%")
 
-    commands_manager = [
-        BotCommand(command="check", description="🔎 Поиск (Мои)"),
-        BotCommand(command="my_offers", description="📋 Список (Мои)"),
-        BotCommand(command="add", description="➕ Добавить"),
-        BotCommand(command="edit", description="✏️ Изменить"),
-        BotCommand(command="del", description="🗑 Удалить"),
-        BotCommand(command="export", description="📊 Excel (Мои)"),
-        BotCommand(command="help", description="ℹ️ Помощь"),
-    ]
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    count_sql = f"SELECT COUNT(*) FROM users{where}"
 
-    commands_admin = [
-        BotCommand(command="check", description="🔎 Поиск (Актив)"),
-        BotCommand(command="check_archive", description="🗄 Поиск (Все)"),
+    page_conditions = list(conditions)
+    page_params = list(params)
+    if before_id is not None:
+        page_conditions.append("user_id < ?")
+        page_params.append(before_id)
+        order = "DESC"
+    else:
+        if after_id is not None:
+            page_conditions.append("user_id > ?")
+            page_params.append(after_id)
+        order = "ASC"
+
+    page_where = " WHERE " + " AND ".join(page_conditions) if page_conditions else ""
+    page_sql = f"SELECT user_id, username, role FROM users{page_where} ORDER BY user_id {order} LIMIT ?"
+    return count_sql, params, page_sql, page_params + [limit + 1]
+
+
+def build_users_offer_counts_query(ids):
+    placeholders = ",".join("?" * len(ids))
+    return f"SELECT added_by, COUNT(*) FROM offers WHERE is_active = 1 AND added_by IN ({placeholders}) GROUP BY added_by"
+
+
+def finish_users_page(rows, total, counts, after_id, before_id, limit):
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if before_id is not None:
+        rows.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = after_id is not None, has_more
+
+    page = [(uid, uname, urole, counts.get(uid, 0)) for uid, uname, urole in rows]
+    return page, total, has_prev, has_next
+
+
+def get_users_page_db(role_filter=None, name_filter=None, after_id=None, before_id=None, limit=USERS_PAGE_SIZE):
+    count_sql, count_params, page_sql, page_params = build_users_page_queries(role_filter, name_filter, after_id,
+                                                                              before_id, limit)
+    conn = connect_db(readonly=True)
+    conn.execute('BEGIN')
+    total = conn.execute(count_sql, count_params).fetchone()[0]
+    rows = conn.execute(page_sql, page_params).fetchall()
+
+    counts = {}
+    ids = [r[0] for r in rows[:limit]]
+    if ids:
+        counts = dict(conn.execute(build_users_offer_counts_query(ids), ids).fetchall())
+    conn.close()
+    return finish_users_page(rows, total, counts, after_id, before_id, limit)
+
+
+def get_menu_hash_db(user_id):
+    if user_id in MENU_HASHES:
+        return MENU_HASHES[user_id]
+    conn = connect_db(readonly=True)
+    row = conn.execute('SELECT commands_hash FROM menu_state WHERE user_id = ?', (user_id,)).fetchone()
+    conn.close()
+    MENU_HASHES[user_id] = row[0] if row else None
+    return MENU_HASHES[user_id]
+
+
+def set_menu_hash_db(user_id, commands_hash):
+    conn = connect_db()
+    conn.execute('INSERT OR REPLACE INTO menu_state (user_id, commands_hash) VALUES (?, ?)', (user_id, commands_hash))
+    conn.commit()
+    conn.close()
+    MENU_HASHES.setdefault(user_id, commands_hash)
+
+
+def get_menu_targets_db():
+    conn = connect_db(readonly=True)
+    rows = conn.execute('SELECT user_id, role FROM users').fetchall()
+    conn.close()
+    return rows
+
+
+def add_watch_db(user_id, query):
+    conn = connect_db()
+    count = conn.execute('SELECT COUNT(*) FROM watches WHERE user_id = ?', (user_id,)).fetchone()[0]
+    if count >= BOT_CONFIG['watch_limit']:
+        conn.close()
+        return "limit"
+    cursor = conn.execute('INSERT OR IGNORE INTO watches (user_id, query) VALUES (?, ?)', (user_id, query))
+    conn.commit()
+    conn.close()
+    return cursor.lastrowid if cursor.rowcount else None
+
+
+def get_user_watches_db(user_id):
+    conn = connect_db(readonly=True)
+    rows = conn.execute('SELECT id, query FROM watches WHERE user_id = ? ORDER BY id', (user_id,)).fetchall()
+    conn.close()
+    return rows
+
+
+def delete_watch_db(user_id, watch_id):
+    conn = connect_db()
+    cursor = conn.execute('DELETE FROM watches WHERE id = ? AND user_id = ?', (watch_id, user_id))
+    conn.commit()
+    conn.close()
+    return cursor.rowcount > 0
+
+
+def get_watches_db():
+    conn = connect_db(readonly=True)
+    rows = conn.execute('SELECT id, user_id, query FROM watches').fetchall()
+    conn.close()
+    return rows
+
+
+def archive_offers_batch_db(after_days, batch_size=ARCHIVE_BATCH_SIZE):
+    conn = connect_db()
+    ids = [r[0] for r in conn.execute(
+        "SELECT id FROM offers WHERE is_active = 0 AND archived_at < datetime('now', ?) ORDER BY id LIMIT ?",
+        (f"-{after_days} days", batch_size)
+    ).fetchall()]
+    if ids:
+        placeholders = ",".join("?" * len(ids))
+        conn.execute(f"INSERT OR REPLACE INTO offers_archive ({ARCHIVE_COLUMNS}) "
+                     f"SELECT {ARCHIVE_COLUMNS} FROM offers WHERE id IN ({placeholders})", ids)
+        conn.execute(f"DELETE FROM offers WHERE id IN ({placeholders})", ids)
+        conn.commit()
+    conn.close()
+    return len(ids)
+
+
+def is_offer_active_db(offer_id):
+    conn = connect_db(readonly=True)
+    row = conn.execute('SELECT is_active FROM offers WHERE id = ?', (offer_id,)).fetchone()
+    conn.close()
+    return bool(row and row[0])
+
+
+def build_stats_queries(limit=STATS_TOP_LIMIT, days=STATS_DAYS):
+    top_sql = 'SELECT key, value FROM offer_stats WHERE dim = ? AND value > 0 ORDER BY value DESC, key LIMIT ?'
+    return [
+        ('total', 'SELECT key, value FROM offer_stats WHERE dim = ?', ['total']),
+        ('geo', top_sql, ['geo', limit]),
+        ('pp', top_sql, ['pp', limit]),
+        ('manager', top_sql, ['manager', limit]),
+        ('day', 'SELECT key, value FROM offer_stats WHERE dim = ? ORDER BY key DESC LIMIT ?', ['day', days]),
+    ]
+
+
+def build_usernames_query(ids):
+    return f"SELECT user_id, username FROM users WHERE user_id IN ({','.join('?' * len(ids))})"
+
+
+def finish_stats(results, names):
+    stats = dict(results)
+    stats['total'] = dict(stats['total'])
+    stats['manager'] = [(int(uid), names.get(int(uid)), value) for uid, value in stats['manager']]
+    stats['day'] = stats['day'][::-1]
+    return stats
+
+
+def get_offer_stats_db(limit=STATS_TOP_LIMIT, days=STATS_DAYS):
+    conn = connect_db(readonly=True)
+    conn.execute('BEGIN')
+    results = [(name, conn.execute(sql, params).fetchall()) for name, sql, params in build_stats_queries(limit, days)]
+    ids = [int(uid) for uid, _ in dict(results)['manager']]
+    names = dict(conn.execute(build_usernames_query(ids), ids).fetchall()) if ids else {}
+    conn.close()
+    return finish_stats(results, names)
+
+
+def get_commands_for_role(role):
+    commands_user = [
+        BotCommand(command="check", description="🔎 Поиск"),
+        BotCommand(command="watch", description="🔔 Подписки"),
+        BotCommand(command="export", description="📊 Excel"),
+        BotCommand(command="help", description="ℹ️ Помощь"),
+    ]
+
+    commands_manager = [
+        BotCommand(command="check", description="🔎 Поиск (Мои)"),
+        BotCommand(command="my_offers", description="📋 Список (Мои)"),
+        BotCommand(command="add", description="➕ Добавить"),
+        BotCommand(command="edit", description="✏️ Изменить"),
+        BotCommand(command="del", description="🗑 Удалить"),
+        BotCommand(command="history", description="🕓 История"),
+        BotCommand(command="export", description="📊 Excel (Мои)"),
+        BotCommand(command="help", description="ℹ️ Помощь"),
+    ]
+
+    commands_admin = [
+        BotCommand(command="check", description="🔎 Поиск (Актив)"),
+        BotCommand(command="check_archive", description="🗄 Поиск (Все)"),
         BotCommand(command="add", description="➕ Добавить"),
         BotCommand(command="edit", description="✏️ Изменить"),
         BotCommand(command="del", description="🗑 Удалить"),
+        BotCommand(command="history", description="🕓 История"),
+        BotCommand(command="dedup", description="🔁 Дубли"),
+        BotCommand(command="stats", description="📊 Статистика"),
+        BotCommand(command="watch", description="🔔 Подписки"),
         BotCommand(command="invite", description="🎫 Создать ссылку"),
         BotCommand(command="export", description="📊 Excel"),
         BotCommand(command="export_archive", description="🗄 Excel (Архив)"),
@@ -387,6 +1692,9 @@ async def update_command_menu(bot: Bot, user_id: int, role: str):
         BotCommand(command="setlog", description="📢 Лог-чат"),
         BotCommand(command="fire", description="☠️ Бан"),
         BotCommand(command="config", description="⚙️ Настр"),
+        BotCommand(command="metrics", description="📈 Метрики"),
+        BotCommand(command="profile", description="⏱ Профиль"),
+        BotCommand(command="memsnap", description="🧠 Память"),
     ]
 
     selected = commands_user
@@ -398,86 +1706,443 @@ async def update_command_menu(bot: Bot, user_id: int, role: str):
         selected = commands_super
     elif role == ROLE_BANNED:
         selected = []
+    return selected
 
-    try:
-        await bot.set_my_commands(selected, scope=BotCommandScopeChat(chat_id=user_id))
-    except Exception as e:
-        logging.error(f"Menu Error: {e}")
+
+def hash_commands(commands):
+    payload = json.dumps([(c.command, c.description) for c in commands], ensure_ascii=False)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
 
 
-async def send_log_to_chat(text: str):
-    log_chat_id = BOT_CONFIG.get('log_chat_id', 0)
-    if log_chat_id != 0:
+def hash_menu_definitions():
+    return hashlib.sha1("|".join(hash_commands(get_commands_for_role(r)) for r in ALL_ROLES).encode()).hexdigest()
+
+
+def enqueue_api_call(factory, name="api", on_drop=None):
+    SEND_QUEUE.put_nowait((factory, name, on_drop))
+
+
+async def send_queue_worker():
+    while True:
+        factory, name, on_drop = await SEND_QUEUE.get()
         try:
-            await bot.send_message(log_chat_id, text, parse_mode="HTML")
+            for attempt in range(3):
+                try:
+                    await factory()
+                    break
+                except TelegramRetryAfter as e:
+                    metric_inc('send_queue_retry_after')
+                    await asyncio.sleep(e.retry_after)
+            else:
+                metric_inc('send_queue_dropped')
+                logging.error(f"Send Queue Error ({name}): dropped after {attempt + 1} flood waits")
+                if on_drop:
+                    on_drop()
         except Exception as e:
-            logging.error(f"Failed to send log: {e}")
+            metric_inc('send_queue_errors')
+            logging.error(f"Send Queue Error ({name}): {e}")
+        finally:
+            SEND_QUEUE.task_done()
+        await asyncio.sleep(SEND_QUEUE_INTERVAL)
 
 
-async def perform_search(message: Message, query: str, show_all: bool, restrict_user_id=None):
-    try:
-        rows = search_offers_db(query, show_all=show_all, restrict_to_user_id=restrict_user_id)
+async def update_command_menu(bot: Bot, user_id: int, role: str, force: bool = False):
+    selected = get_commands_for_role(role)
+    commands_hash = hash_commands(selected)
 
-        if not rows:
-            return await message.answer(f"📭 Ничего не найдено.")
+    if not force and await STORAGE.get_menu_hash(user_id) == commands_hash:
+        metric_inc('menu_sync_skipped')
+        return
+
+    def forget():
+        if MENU_HASHES.get(user_id) == commands_hash:
+            del MENU_HASHES[user_id]
+
+    async def push():
+        try:
+            await bot.set_my_commands(selected, scope=BotCommandScopeChat(chat_id=user_id))
+        except TelegramRetryAfter:
+            raise
+        except Exception as e:
+            logging.error(f"Menu Error: {e}")
+            forget()
+            return
+        await STORAGE.set_menu_hash(user_id, commands_hash)
+        metric_inc('menu_sync_pushed')
 
-        total_found = len(rows)
-        LIMIT_VIEW = 20
+    MENU_HASHES[user_id] = commands_hash
+    enqueue_api_call(push, "menu", on_drop=forget)
 
-        if total_found > LIMIT_VIEW:
-            rows = rows[:LIMIT_VIEW]
-            await message.answer(f"⚠️ <b>Найдено: {total_found}.</b> Первые {LIMIT_VIEW}.", parse_mode="HTML")
 
-        res = []
-        for r in rows:
-            oid = r[0]
-            pp_name = str(r[1] or "—")
-            offer_name = str(r[2] or "—")
-            geo = str(r[3] or "Global")
-            rate = str(r[4] or "—")
-            raw_details_db = str(r[5] or "")
-            is_active = r[6]
+async def resync_command_menus():
+    defs_hash = hash_menu_definitions()
+    if BOT_CONFIG['menu_defs_hash'] == defs_hash:
+        return 0
 
-            raw_details = raw_details_db.replace("Аппрув:", "Гарант:")
+    targets = {SUPERADMIN_ID: ROLE_SUPERADMIN}
+    for user_id, role in await STORAGE.get_menu_targets():
+        targets.setdefault(user_id, role)
 
-            formatted_details = ""
-            if " | " in raw_details:
-                try:
-                    part_garant, part_info = raw_details.split(" | ", 1)
-                    formatted_details = f"✅ {part_garant}\n📝 {part_info}"
-                except:
-                    formatted_details = f"📝 {raw_details}"
+    for user_id, role in targets.items():
+        await update_command_menu(bot, user_id, role, force=True)
+
+    await set_setting('menu_defs_hash', defs_hash)
+    return len(targets)
+
+
+def event_key(event, kind):
+    if isinstance(event, CallbackQuery):
+        return f"{kind}:cb:{event.id}"
+    return f"{kind}:{event.chat.id}:{event.message_id}"
+
+
+def log_outbox(text, key=None):
+    log_chat_id = BOT_CONFIG['log_chat_id']
+    return [(key, log_chat_id, text)] if log_chat_id != 0 else []
+
+
+def offer_log_outbox(key, render):
+    return lambda offer_id, data: log_outbox(render(offer_id, data), key)
+
+
+def outbox_backoff(attempts):
+    return min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** attempts)
+
+
+async def deliver_outbox_message(chat_id, text):
+    while True:
+        try:
+            return await bot.send_message(chat_id, text, parse_mode="HTML")
+        except TelegramRetryAfter as e:
+            metric_inc('outbox_retry_after')
+            await asyncio.sleep(e.retry_after)
+
+
+async def outbox_dispatcher():
+    while True:
+        try:
+            batch = await STORAGE.claim_outbox()
+        except Exception as e:
+            logging.error(f"Outbox Claim Error: {e}")
+            batch = []
+        if not batch:
+            await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+            continue
+
+        results = []
+        for outbox_id, chat_id, text, attempts in batch:
+            try:
+                await deliver_outbox_message(chat_id, text)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                metric_inc('outbox_dead')
+                logging.error(f"Outbox Error ({chat_id}): {e}")
+                results.append(('dead', 0, str(e), time.time(), outbox_id))
+            except Exception as e:
+                if attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+                    metric_inc('outbox_dead')
+                    logging.error(f"Outbox Error ({chat_id}), giving up after {attempts + 1} attempts: {e}")
+                    results.append(('dead', 0, str(e), time.time(), outbox_id))
+                else:
+                    metric_inc('outbox_retry')
+                    results.append(('pending', time.time() + outbox_backoff(attempts), str(e), None, outbox_id))
             else:
-                formatted_details = f"📝 {raw_details}"
+                metric_inc('outbox_sent')
+                results.append(('sent', 0, None, time.time(), outbox_id))
+            await asyncio.sleep(SEND_QUEUE_INTERVAL)
+
+        try:
+            await STORAGE.finish_outbox(results)
+        except Exception as e:
+            logging.error(f"Outbox Finish Error: {e}")
+
+
+async def find_offers(query, show_all, restrict_user_id, limit):
+    if MEMORY_INDEX and not show_all and MEMORY_INDEX.supports(query):
+        metric_inc('search_memory')
+        return MEMORY_INDEX.search(query, restrict_to_user_id=restrict_user_id, limit=limit)
+    metric_inc('search_sql')
+    query = normalize_query_key(query)
+    result, _ = await run_single_flight(
+        'search', (query, show_all, restrict_user_id, limit, OFFERS_VERSION),
+        lambda: STORAGE.search_offers(query, show_all=show_all, restrict_to_user_id=restrict_user_id, limit=limit)
+    )
+    return result
 
-            prefix = "🗑 " if is_active == 0 else "✅ " if show_all else ""
 
-            item_text = (
-                f"{prefix}🆔 <code>{oid}</code>\n"
-                f"🏢 <b>{pp_name}</b>\n"
-                f"🏷 {offer_name}\n"
-                f"🌍 {geo}\n"
-                f"💰 {rate}\n"
-                f"{formatted_details}"
-            )
-            res.append(item_text)
+def tg_len(text):
+    return len(text.encode('utf-16-le')) // 2
+
+
+def visible_len(html_text):
+    return tg_len(html.unescape(HTML_TAG_RE.sub("", html_text)))
+
+
+def count_entities(html_text):
+    return sum(1 for m in HTML_TAG_RE.finditer(html_text) if not m.group(1))
+
+
+def split_long_html(text, limit):
+    parts = []
+    current, size, open_tags = "", 0, []
+
+    for token in HTML_TOKEN_RE.findall(text):
+        tag = HTML_TAG_RE.fullmatch(token)
+        if tag:
+            if tag.group(1):
+                if open_tags: open_tags.pop()
+            else:
+                open_tags.append((tag.group(2), token))
+            current += token
+            continue
+
+        for piece in ([token] if token.startswith('&') and len(token) > 1 else token):
+            cost = visible_len(piece) if piece.startswith('&') else tg_len(piece)
+            if size + cost > limit and size:
+                parts.append(current + "".join(f"</{name}>" for name, _ in reversed(open_tags)))
+                current, size = "".join(opening for _, opening in open_tags), 0
+            current += piece
+            size += cost
+
+    if size or not parts:
+        parts.append(current)
+    return parts
+
+
+def join_html_parts(parts, separator, limit, max_entities):
+    messages = []
+    current, size, entities = None, 0, 0
+    sep_len = visible_len(separator)
+
+    for part in parts:
+        part_len, part_entities = visible_len(part), count_entities(part)
+        if current is not None and size + sep_len + part_len <= limit and entities + part_entities <= max_entities:
+            current += separator + part
+            size += sep_len + part_len
+            entities += part_entities
+        else:
+            if current is not None: messages.append(current)
+            current, size, entities = part, part_len, part_entities
+
+    if current is not None: messages.append(current)
+    return messages
+
+
+def split_html(text, limit=MESSAGE_LIMIT, max_entities=MESSAGE_ENTITY_LIMIT):
+    if visible_len(text) <= limit and count_entities(text) <= max_entities:
+        return [text]
+    lines = []
+    for line in text.split("\n"):
+        lines.extend(split_long_html(line, limit) if visible_len(line) > limit else [line])
+    return join_html_parts(lines, "\n", limit, max_entities)
+
+
+def pack_messages(blocks, separator="\n\n", limit=MESSAGE_LIMIT, max_entities=MESSAGE_ENTITY_LIMIT):
+    parts = [part for block in blocks for part in split_html(block, limit, max_entities)]
+    return join_html_parts(parts, separator, limit, max_entities)
+
+
+def truncate_html(text, limit):
+    if visible_len(text) <= limit:
+        return text
+    return split_long_html(text, limit - 1)[0] + "…"
+
+
+def escape_fields(data):
+    return {field: html.escape(str(data.get(field) or "")) for field in OFFER_FIELDS}
+
+
+def user_link(user):
+    return f"<a href='tg://user?id={user.id}'>{html.escape(user.full_name)}</a>"
+
+
+def render_offer_card(r, show_all=False):
+    oid = r[0]
+    pp_name = html.escape(str(r[1] or "—"))
+    offer_name = html.escape(str(r[2] or "—"))
+    geo = html.escape(str(r[3] or "Global"))
+    rate = html.escape(str(r[4] or "—"))
+    raw_details_db = html.escape(str(r[5] or ""))
+    is_active = r[6]
+
+    raw_details = raw_details_db.replace("Аппрув:", "Гарант:")
+
+    formatted_details = ""
+    if " | " in raw_details:
+        try:
+            part_garant, part_info = raw_details.split(" | ", 1)
+            formatted_details = f"✅ {part_garant}\n📝 {part_info}"
+        except:
+            formatted_details = f"📝 {raw_details}"
+    else:
+        formatted_details = f"📝 {raw_details}"
+
+    prefix = "🗑 " if is_active == 0 else "✅ " if show_all else ""
+
+    return (
+        f"{prefix}🆔 <code>{oid}</code>\n"
+        f"🏢 <b>{pp_name}</b>\n"
+        f"🏷 {offer_name}\n"
+        f"🌍 {geo}\n"
+        f"💰 {rate}\n"
+        f"{formatted_details}"
+    )
+
 
-        chunk_size = 5
-        for i in range(0, len(res), chunk_size):
-            chunk = res[i:i + chunk_size]
-            text = "\n\n➖➖➖➖➖➖➖\n\n".join(chunk)
+async def perform_search(message: Message, query: str, show_all: bool, restrict_user_id=None):
+    try:
+        limit = BOT_CONFIG['search_limit']
+        rows, total_found = await find_offers(query, show_all, restrict_user_id, limit)
+
+        if not rows and query:
+            rows, suggestion = await STORAGE.fuzzy_search(query, show_all=show_all, restrict_to_user_id=restrict_user_id,
+                                                          limit=limit)
+            total_found = len(rows)
+            if rows:
+                metric_inc('search_fuzzy_fallback')
+                await message.answer(f"🤔 Точных совпадений нет. Возможно, вы имели в виду: <b>{html.escape(suggestion)}</b>",
+                                     parse_mode="HTML")
+
+        if not rows:
+            return await message.answer(f"📭 Ничего не найдено.")
+
+        if total_found > limit:
+            await message.answer(f"⚠️ <b>Найдено: {total_found}.</b> Первые {limit}.", parse_mode="HTML")
+
+        messages = pack_messages([render_offer_card(r, show_all) for r in rows], CARD_SEPARATOR)
+        metric_inc('search_messages', len(messages))
+        for i, text in enumerate(messages):
+            if i: await asyncio.sleep(0.3)
             await message.answer(text, parse_mode="HTML")
-            await asyncio.sleep(0.3)
 
     except Exception as e:
         logging.error(f"Search Loop Error: {e}")
         await message.answer(f"⚠️ Ошибка при отображении списка: {e}")
 
 
-async def create_and_send_excel(message: Message, query: str, is_archive_mode: bool, restrict_user_id=None):
-    conn = sqlite3.connect(DB_NAME)
+async def notify_watchers(offer_id, data, author_id, is_update=False):
+    watchers = {}
+    for _, user_id, query in WATCH_INDEX.match(data):
+        if user_id != author_id:
+            watchers.setdefault(user_id, query)
+    if not watchers:
+        return
+    if is_update and not await STORAGE.is_offer_active(offer_id):
+        return
 
-    sql = """
+    metric_inc('watch_matches', len(watchers))
+    for user_id, query in watchers.items():
+        if user_id in WATCH_DIGESTS:
+            defer_watch_notification(user_id, query, offer_id, data, is_update)
+            continue
+        wait = take_throttle_token(user_id, ROLE_USER, 'watch_notify')
+        if wait:
+            defer_watch_notification(user_id, query, offer_id, data, is_update, wait)
+            continue
+        text = f"{'✏️ Обновлен оффер' if is_update else '🔔 Новый оффер'} по подписке «<b>{html.escape(query)}</b>»:" \
+               f"\n\n{render_offer_card(watch_offer_row(offer_id, data))}"
+        enqueue_api_call(functools.partial(send_watch_message, user_id, split_html(text)[0]), "watch")
+
+
+def watch_offer_row(offer_id, data):
+    return (offer_id, data['pp_name'], data['offer_name'], data.get('geo', 'Global'), data['rate'],
+            data.get('details', '-'), 1)
+
+
+def defer_watch_notification(user_id, query, offer_id, data, is_update, delay=None):
+    metric_inc('watch_throttled')
+    pending = WATCH_DIGESTS.get(user_id)
+    if pending is None:
+        pending = WATCH_DIGESTS[user_id] = {}
+        asyncio.get_running_loop().call_later(delay or 0, flush_watch_digest, user_id)
+    if offer_id not in pending and len(pending) >= WATCH_DIGEST_LIMIT:
+        WATCH_DIGEST_SKIPPED[user_id] += 1
+        return
+    pending[offer_id] = (query, data, is_update)
+
+
+def flush_watch_digest(user_id):
+    wait = take_throttle_token(user_id, ROLE_USER, 'watch_notify')
+    if wait:
+        asyncio.get_running_loop().call_later(wait, flush_watch_digest, user_id)
+        return
+
+    pending = WATCH_DIGESTS[user_id]
+    batch = [(offer_id, *pending.pop(offer_id)) for offer_id in list(pending)[:WATCH_DIGEST_BATCH]]
+    skipped = 0
+    if pending:
+        asyncio.get_running_loop().call_later(0, flush_watch_digest, user_id)
+    else:
+        del WATCH_DIGESTS[user_id]
+        skipped = WATCH_DIGEST_SKIPPED.pop(user_id, 0)
+
+    blocks = [f"🔔 <b>Совпадения по подпискам ({len(batch)})</b>"]
+    for offer_id, query, data, is_update in batch:
+        blocks.append(f"{'✏️' if is_update else '🆕'} «<b>{html.escape(query)}</b>»\n"
+                      f"{render_offer_card(watch_offer_row(offer_id, data))}")
+    if skipped:
+        blocks.append(f"…и еще совпадений: {skipped}. Используйте /check.")
+    metric_inc('watch_digests')
+    for text in pack_messages(blocks):
+        enqueue_api_call(functools.partial(send_watch_message, user_id, text), "watch")
+
+
+async def send_watch_message(user_id, text):
+    role = await STORAGE.get_user_role(user_id)
+    if role not in [ROLE_USER, ROLE_ADMIN, ROLE_SUPERADMIN]:
+        return
+
+    try:
+        await bot.send_message(user_id, text, parse_mode="HTML")
+    except TelegramRetryAfter:
+        raise
+    except Exception as e:
+        logging.error(f"Watch Notify Error: {e}")
+    else:
+        metric_inc('watch_notified')
+
+
+def render_stats(stats):
+    total = stats['total']
+    lines = [f"📊 <b>Статистика</b>",
+             f"Активных офферов: <b>{total.get('active', 0)}</b> | Добавлено всего: <b>{total.get('added', 0)}</b>"]
+    sections = [
+        ("🌍 <b>Гео (активные):</b>", [(html.escape(key or '-'), value) for key, value in stats['geo']]),
+        ("🏷 <b>ПП (активные):</b>", [(html.escape(key or '-'), value) for key, value in stats['pp']]),
+        ("👔 <b>Менеджеры (добавлено):</b>",
+         [(f"@{html.escape(name)}" if name else f"<code>{uid}</code>", value) for uid, name, value in stats['manager']]),
+        (f"📅 <b>Добавления за {BOT_CONFIG['stats_days']} дн.:</b>", [(day, value) for day, value in stats['day']]),
+    ]
+    for title, items in sections:
+        if items:
+            lines.append("")
+            lines.append(title)
+            lines.extend(f"• {label} — {value}" for label, value in items)
+    return "\n".join(lines)
+
+
+def render_stats_chart(stats):
+    # Runs in CHART_EXECUTOR: matplotlib is slow to import and render, keep it off the bot process.
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, (ax_days, ax_geo) = plt.subplots(1, 2, figsize=(11, 4))
+    days = stats['day']
+    ax_days.bar([day[5:] for day, _ in days], [value for _, value in days], color='#4C72B0')
+    ax_days.set_title('Adds per day')
+    ax_days.tick_params(axis='x', rotation=60, labelsize=8)
+    geo = stats['geo'][::-1]
+    ax_geo.barh([key or '-' for key, _ in geo], [value for _, value in geo], color='#55A868')
+    ax_geo.set_title('Active offers by geo')
+    fig.tight_layout()
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=110)
+    plt.close(fig)
+    return buf.getvalue()
+
+
+def build_export_query(query, is_archive_mode, restrict_user_id=None):
+    sql = f"""
     SELECT 
         t1.id, 
         t1.pp_name, 
@@ -488,7 +2153,7 @@ async def create_and_send_excel(message: Message, query: str, is_archive_mode: b
         t1.is_active, 
         t1.added_by,
         t2.username
-    FROM offers t1
+    FROM {offers_source(is_archive_mode, "t1")}
     LEFT JOIN users t2 ON t1.added_by = t2.user_id
     """
 
@@ -517,13 +2182,101 @@ async def create_and_send_excel(message: Message, query: str, is_archive_mode: b
         sql += " WHERE " + " AND ".join(conditions)
 
     sql += " ORDER BY t1.id DESC"
+    return sql, params
+
+
+def get_export_arrow_schema(declared):
+    fields = []
+    for col in EXPORT_COLUMNS:
+        decl = declared.get(col, 'TEXT')
+        if 'INT' in decl:
+            fields.append(pa.field(col, pa.int64()))
+        elif 'BOOL' in decl:
+            fields.append(pa.field(col, pa.bool_()))
+        else:
+            fields.append(pa.field(col, pa.string()))
+    return pa.schema(fields)
+
+
+def get_sqlite_column_types(conn):
+    declared = {row[1]: (row[2] or '').upper() for row in conn.execute("PRAGMA table_info(offers)")}
+    declared['username'] = 'TEXT'
+    return declared
+
+
+class ExportWriter:
+    def __init__(self, fname, fmt, declared=None):
+        self.fname = fname
+        self.fmt = fmt
+        self.total = 0
+        self.rows = []
+        self.file = None
+        self.writer = None
+        self.schema = None
+
+        if fmt in ['csv', 'csvgz']:
+            opener = gzip.open if fmt == 'csvgz' else open
+            self.file = opener(fname, 'wt', encoding='utf-8', newline='')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(EXPORT_COLUMNS)
+        elif fmt == 'jsonl':
+            self.file = open(fname, 'w', encoding='utf-8')
+        elif fmt == 'parquet':
+            self.schema = get_export_arrow_schema(declared or {})
+            self.writer = pq.ParquetWriter(fname, self.schema, compression='zstd')
+
+    def write(self, batch):
+        self.total += len(batch)
+        if self.fmt in ['csv', 'csvgz']:
+            self.writer.writerows(batch)
+        elif self.fmt == 'jsonl':
+            for row in batch:
+                self.file.write(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n")
+        elif self.fmt == 'parquet':
+            arrays = []
+            for i, field in enumerate(self.schema):
+                values = [r[i] for r in batch]
+                if pa.types.is_boolean(field.type):
+                    values = [None if v is None else bool(v) for v in values]
+                elif pa.types.is_string(field.type):
+                    values = [None if v is None else str(v) for v in values]
+                arrays.append(pa.array(values, type=field.type))
+            self.writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        else:
+            self.rows.extend(tuple(r) for r in batch)
+
+    def close(self):
+        if self.fmt == 'parquet':
+            self.writer.close()
+        elif self.file:
+            self.file.close()
+        elif self.rows:
+            write_export_xlsx(pd.DataFrame(self.rows, columns=EXPORT_COLUMNS), self.fname)
+        return self.total
 
-    df = pd.read_sql_query(sql, conn, params=params)
-    conn.close()
 
-    if df.empty:
-        return await message.answer(f"📭 Данных не найдено.")
+def write_export_stream(conn, sql, params, fname, fmt):
+    cursor = conn.execute(sql, params)
+    writer = ExportWriter(fname, fmt, get_sqlite_column_types(conn) if fmt == 'parquet' else None)
+    try:
+        while True:
+            batch = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not batch: break
+            writer.write(batch)
+    finally:
+        total = writer.close()
+    return total
 
+
+def format_size(num_bytes):
+    for unit in ['B', 'KB', 'MB']:
+        if num_bytes < 1024:
+            return f"{num_bytes:.0f} {unit}" if unit == 'B' else f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} GB"
+
+
+def write_export_xlsx(df, fname):
     def format_user(row):
         uid = row['added_by']
         uname = row['username']
@@ -542,35 +2295,1042 @@ async def create_and_send_excel(message: Message, query: str, is_archive_mode: b
 
     df = df.drop(columns=['username'])
 
-    wait_msg = await message.answer("⏳ Генерация файла...")
-    fname = f"export_{int(time.time())}.xlsx"
     sheet_name = 'Offers'
 
+    with pd.ExcelWriter(fname, engine='xlsxwriter') as writer:
+        df.to_excel(writer, sheet_name=sheet_name, index=False)
+        workbook = writer.book
+        worksheet = writer.sheets[sheet_name]
+        (max_row, max_col) = df.shape
+
+        if max_row > 0:
+            worksheet.autofilter(0, 0, max_row, max_col - 1)
+
+        worksheet.set_column(0, 0, 5)
+        worksheet.set_column(1, 2, 20)
+        worksheet.set_column(3, 3, 15)
+        worksheet.set_column(7, 7, 25)
+
+    return max_row
+
+
+def build_export_file(query, is_archive_mode, restrict_user_id=None, fmt='xlsx'):
+    sql, params = build_export_query(query, is_archive_mode, restrict_user_id)
+    fname = make_export_fname(fmt)
+
+    started = time.perf_counter()
+    conn = connect_db(readonly=True)
     try:
-        with pd.ExcelWriter(fname, engine='xlsxwriter') as writer:
-            df.to_excel(writer, sheet_name=sheet_name, index=False)
-            workbook = writer.book
-            worksheet = writer.sheets[sheet_name]
-            (max_row, max_col) = df.shape
+        total = write_export_stream(conn, sql, params, fname, fmt)
+    except BaseException:
+        if os.path.exists(fname): os.remove(fname)
+        raise
+    finally:
+        conn.close()
+    return finish_export_file(fname, total, started, query, is_archive_mode, restrict_user_id, fmt)
+
 
-            if max_row > 0:
-                worksheet.autofilter(0, 0, max_row, max_col - 1)
+def make_export_fname(fmt):
+    return f"export_{int(time.time())}_{uuid.uuid4().hex[:6]}{EXPORT_FORMATS[fmt]}"
+
+
+def finish_export_file(fname, total, started, query, is_archive_mode, restrict_user_id, fmt):
+    elapsed = time.perf_counter() - started
+    metric_observe(f"export_{fmt}", elapsed)
+
+    if total == 0:
+        if os.path.exists(fname): os.remove(fname)
+        return None
 
-            worksheet.set_column(0, 0, 5)
-            worksheet.set_column(1, 2, 20)
-            worksheet.set_column(3, 3, 15)
-            worksheet.set_column(7, 7, 25)
+    caption = build_export_caption(query, is_archive_mode, restrict_user_id, fmt, os.path.getsize(fname), elapsed)
+    return fname, caption, elapsed
 
-        mode_text = "🗄 АРХИВ" if is_archive_mode else "📊 АКТИВНЫЕ"
-        if restrict_user_id: mode_text += " (МОИ)"
 
-        caption = f"{mode_text} | Фильтр: '{query}'" if query else f"{mode_text} | Полная база"
-        await message.answer_document(FSInputFile(fname), caption=caption)
+def cache_export(cache_key, version, file_id, caption):
+    EXPORT_CACHE.pop(cache_key, None)
+    EXPORT_CACHE[cache_key] = (version, file_id, caption)
+    while len(EXPORT_CACHE) > EXPORT_CACHE_LIMIT:
+        EXPORT_CACHE.pop(next(iter(EXPORT_CACHE)))
+
+
+async def create_and_send_excel(message: Message, query: str, is_archive_mode: bool, restrict_user_id=None,
+                                fmt='xlsx'):
+    if fmt == 'parquet' and pa is None:
+        return await message.answer("⚠️ Формат parquet недоступен (не установлен pyarrow).")
+
+    query = normalize_query_key(query)
+    cache_key = (fmt, query, is_archive_mode, restrict_user_id)
+    cached = EXPORT_CACHE.get(cache_key)
+    if cached and cached[0] == OFFERS_VERSION:
+        metric_inc('export_cache_hits')
+        return await message.answer_document(cached[1], caption=f"{cached[2]} | 💾 кэш")
+    metric_inc('export_cache_misses')
+
+    wait_msg = await message.answer("⏳ Генерация файла...")
+
+    async def generate():
+        version = OFFERS_VERSION
+        result = await STORAGE.export_offers(query, is_archive_mode, restrict_user_id, fmt)
+        return SharedExport(*result, version) if result else None
+
+    try:
+        shared, is_leader = await run_single_flight('export', cache_key + (OFFERS_VERSION,), generate)
+        if not shared:
+            return await message.answer(f"📭 Данных не найдено.")
+
+        if not is_leader:
+            metric_inc('export_saved_seconds', round(shared.elapsed, 3))
+        await shared.send(message, cache_key)
     except Exception as e:
+        logging.error(f"Export Error: {e}")
         await message.answer(f"⚠️ Ошибка экспорта: {e}")
     finally:
         await wait_msg.delete()
-        if os.path.exists(fname): os.remove(fname)
+
+
+class SharedExport:
+    """Export file built once for coalesced requesters; each of them sends its own copy."""
+
+    def __init__(self, fname, caption, elapsed, version):
+        self.fname = fname
+        self.caption = caption
+        self.elapsed = elapsed
+        self.version = version
+        self.file_id = None
+        self.lock = asyncio.Lock()
+        self.discard = weakref.finalize(self, remove_file, fname)
+
+    async def send(self, message, cache_key):
+        async with self.lock:
+            if self.file_id:
+                return await message.answer_document(self.file_id, caption=self.caption)
+            sent = await message.answer_document(FSInputFile(self.fname), caption=self.caption)
+            self.file_id = sent.document.file_id
+            self.discard()
+            cache_export(cache_key, self.version, self.file_id, self.caption)
+
+
+def remove_file(fname):
+    if os.path.exists(fname): os.remove(fname)
+
+
+def build_export_caption(query, is_archive_mode, restrict_user_id, fmt, size, elapsed):
+    mode_text = "🗄 АРХИВ" if is_archive_mode else "📊 АКТИВНЫЕ"
+    if restrict_user_id: mode_text += " (МОИ)"
+
+    caption = f"{mode_text} | Фильтр: '{query}'" if query else f"{mode_text} | Полная база"
+    return f"{caption}\n📦 {fmt} | {format_size(size)} | ⏱ {elapsed:.2f} сек"
+
+
+def sqlite_read(fn):
+    async def method(self, *args, **kwargs):
+        return await db_read(fn, *args, **kwargs)
+    return method
+
+
+def sqlite_write(fn):
+    async def method(self, *args, **kwargs):
+        return await db_write(fn, *args, **kwargs)
+    return method
+
+
+class SQLiteStorage:
+    """Default backend: the module-level sqlite functions run on the reader pool / single writer thread."""
+
+    async def init(self):
+        await db_write(init_db)
+        apply_settings(await self.load_settings())
+
+    async def close(self):
+        pass
+
+    async def claim_job_run(self, name, run_at):
+        return True
+
+    load_settings = sqlite_read(load_settings_db)
+    get_settings_version = sqlite_read(get_settings_version_db)
+    set_setting = sqlite_write(update_setting_db)
+    maintain = sqlite_write(maintain_db)
+
+    create_invite = sqlite_write(create_invite_db)
+    use_invite = sqlite_write(check_and_use_invite)
+    cleanup_invites = sqlite_write(cleanup_invites_db)
+
+    get_user_role = sqlite_read(get_user_role)
+    add_user = sqlite_write(add_user)
+    update_user_role = sqlite_write(update_user_role)
+    get_users_page = sqlite_read(get_users_page_db)
+    get_menu_hash = sqlite_read(get_menu_hash_db)
+    set_menu_hash = sqlite_write(set_menu_hash_db)
+    get_menu_targets = sqlite_read(get_menu_targets_db)
+
+    async def add_offer(self, data, user_id, outbox=None):
+        new_id = await db_write(add_offer_db, data, user_id, outbox)
+        await notify_watchers(new_id, data, user_id)
+        return new_id
+
+    async def update_offer(self, offer_id, data, user_id, role, outbox=None):
+        result = await db_write(update_offer_db, offer_id, data, user_id, role, outbox)
+        if result == True:
+            await notify_watchers(offer_id, data, user_id, is_update=True)
+        return result
+
+    is_offer_active = sqlite_read(is_offer_active_db)
+    archive_offers_batch = sqlite_write(archive_offers_batch_db)
+    delete_offer = sqlite_write(delete_offer_db)
+    get_offer = sqlite_read(get_offer_by_id)
+    check_offer_ownership = sqlite_read(check_offer_ownership_db)
+    find_duplicate = sqlite_read(find_duplicate_offer_db)
+    find_duplicate_groups = sqlite_read(find_duplicate_groups_db)
+    merge_duplicates = sqlite_write(merge_duplicate_offers_db)
+    get_offer_history = sqlite_read(get_offer_history_db)
+    compact_history = sqlite_write(compact_offer_history_db)
+    get_active_offers = sqlite_read(get_active_offers_db)
+    get_stats = sqlite_read(get_offer_stats_db)
+
+    enqueue_outbox = sqlite_write(enqueue_outbox_db)
+    claim_outbox = sqlite_write(claim_outbox_db)
+    finish_outbox = sqlite_write(finish_outbox_db)
+    purge_outbox = sqlite_write(purge_outbox_db)
+
+    add_watch = sqlite_write(add_watch_db)
+    get_user_watches = sqlite_read(get_user_watches_db)
+    delete_watch = sqlite_write(delete_watch_db)
+    get_watches = sqlite_read(get_watches_db)
+
+    search_offers = sqlite_read(search_offers_db)
+    fuzzy_search = sqlite_read(fuzzy_search_offers_db)
+    get_my_offers_page = sqlite_read(get_my_offers_page_db)
+    export_offers = sqlite_read(build_export_file)
+
+
+def to_pg_sql(sql):
+    counter = iter(range(1, sys.maxsize))
+    sql = re.sub(r"\?", lambda m: f"${next(counter)}", sql)
+    return re.sub(r"\bLIKE\b", "ILIKE", sql)
+
+
+def pg_rowcount(status):
+    return int(status.split()[-1])
+
+
+def make_search_text(pp_name, offer_name) -> str:
+    return " ".join(split_words(pp_name) + split_words(offer_name))
+
+
+PG_UTC_NOW = "(now() AT TIME ZONE 'utc')"
+
+PG_SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS offers (
+    id BIGSERIAL PRIMARY KEY,
+    pp_name TEXT,
+    offer_name TEXT,
+    geo TEXT,
+    rate TEXT,
+    details TEXT,
+    is_active SMALLINT DEFAULT 1,
+    created_at TIMESTAMP DEFAULT {PG_UTC_NOW},
+    added_by BIGINT DEFAULT NULL,
+    dedup_key TEXT DEFAULT NULL,
+    search_text TEXT DEFAULT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_offers_dedup ON offers(dedup_key, is_active);
+CREATE INDEX IF NOT EXISTS idx_offers_owner ON offers(added_by, is_active, id);
+ALTER TABLE offers ADD COLUMN IF NOT EXISTS archived_at TIMESTAMP DEFAULT NULL;
+CREATE INDEX IF NOT EXISTS idx_offers_archived ON offers(is_active, archived_at);
+UPDATE offers SET archived_at = {PG_UTC_NOW} WHERE is_active = 0 AND archived_at IS NULL;
+
+CREATE TABLE IF NOT EXISTS offers_archive (
+    id BIGINT PRIMARY KEY,
+    pp_name TEXT,
+    offer_name TEXT,
+    geo TEXT,
+    rate TEXT,
+    details TEXT,
+    is_active SMALLINT DEFAULT 0,
+    created_at TIMESTAMP,
+    added_by BIGINT DEFAULT NULL,
+    dedup_key TEXT DEFAULT NULL,
+    archived_at TIMESTAMP,
+    search_text TEXT DEFAULT NULL
+);
+
+CREATE TABLE IF NOT EXISTS users (
+    user_id BIGINT PRIMARY KEY,
+    role TEXT DEFAULT 'user',
+    username TEXT,
+    joined_at TIMESTAMP DEFAULT {PG_UTC_NOW}
+);
+CREATE INDEX IF NOT EXISTS idx_users_role ON users(role, user_id);
+
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+CREATE TABLE IF NOT EXISTS job_runs (
+    name TEXT PRIMARY KEY,
+    run_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS invites (
+    code TEXT PRIMARY KEY,
+    role TEXT,
+    uses_left INTEGER DEFAULT 1,
+    created_at TIMESTAMP DEFAULT {PG_UTC_NOW}
+);
+
+CREATE TABLE IF NOT EXISTS menu_state (
+    user_id BIGINT PRIMARY KEY,
+    commands_hash TEXT
+);
+
+CREATE TABLE IF NOT EXISTS offer_history (
+    id BIGSERIAL PRIMARY KEY,
+    offer_id BIGINT NOT NULL,
+    action TEXT,
+    changes TEXT,
+    user_id BIGINT,
+    created_at TIMESTAMP DEFAULT {PG_UTC_NOW}
+);
+CREATE INDEX IF NOT EXISTS idx_offer_history_offer ON offer_history(offer_id, id);
+
+CREATE TABLE IF NOT EXISTS watches (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    query TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT {PG_UTC_NOW},
+    UNIQUE (user_id, query)
+);
+
+CREATE TABLE IF NOT EXISTS offer_stats (
+    dim TEXT,
+    key TEXT,
+    value BIGINT DEFAULT 0,
+    PRIMARY KEY (dim, key)
+);
+CREATE INDEX IF NOT EXISTS idx_offer_stats_top ON offer_stats(dim, value);
+
+CREATE TABLE IF NOT EXISTS outbox (
+    id BIGSERIAL PRIMARY KEY,
+    idem_key TEXT UNIQUE,
+    chat_id BIGINT,
+    text TEXT,
+    status TEXT DEFAULT 'pending',
+    attempts INTEGER DEFAULT 0,
+    next_attempt_at DOUBLE PRECISION DEFAULT 0,
+    last_error TEXT,
+    done_at DOUBLE PRECISION,
+    created_at TIMESTAMP DEFAULT {PG_UTC_NOW}
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(status, next_attempt_at);
+'''
+
+PG_TRGM_SCHEMA = '''
+CREATE INDEX IF NOT EXISTS idx_offers_pp_trgm ON offers USING GIN (pp_name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_offers_name_trgm ON offers USING GIN (offer_name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_offers_geo_trgm ON offers USING GIN (geo gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_offers_search_trgm ON offers USING GIN (search_text gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_offers_archive_search_trgm ON offers_archive USING GIN (search_text gin_trgm_ops);
+'''
+
+
+class PostgresStorage:
+    """asyncpg backend with the same interface as SQLiteStorage.
+
+    Substring search is served by pg_trgm GIN indexes, fuzzy search by word_similarity over a folded
+    `search_text` column, exports stream through a server-side cursor. Offer changes are broadcast with
+    NOTIFY so other bot instances drop their export cache and refresh the memory index.
+    """
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.pool = None
+        self.listener = None
+        self.has_trgm = False
+        self.instance_id = uuid.uuid4().hex[:8]
+
+    async def init(self):
+        if asyncpg is None:
+            raise RuntimeError("DB_BACKEND=postgres requires asyncpg (pip install asyncpg)")
+
+        self.pool = await asyncpg.create_pool(
+            self.dsn, min_size=PG_POOL_MIN_SIZE, max_size=PG_POOL_MAX_SIZE,
+            server_settings={'pg_trgm.word_similarity_threshold': str(PG_FUZZY_THRESHOLD)}
+        )
+        async with self.pool.acquire() as conn:
+            try:
+                await conn.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+                self.has_trgm = True
+            except Exception as e:
+                logging.error(f"pg_trgm unavailable, fuzzy search disabled: {e}")
+
+            await conn.execute(PG_SCHEMA)
+            if self.has_trgm:
+                await conn.execute(PG_TRGM_SCHEMA)
+
+            await conn.execute("INSERT INTO settings (key, value) VALUES ('settings_version', '0') "
+                               "ON CONFLICT (key) DO NOTHING")
+
+            if not await conn.fetchval('SELECT 1 FROM offer_stats LIMIT 1'):
+                await self.rebuild_stats(conn)
+
+            while True:
+                rows = await conn.fetch('SELECT id, pp_name, offer_name, geo FROM offers '
+                                        'WHERE dedup_key IS NULL OR search_text IS NULL LIMIT $1', EXPORT_BATCH_SIZE)
+                if not rows: break
+                await conn.executemany(
+                    'UPDATE offers SET dedup_key = $1, search_text = $2 WHERE id = $3',
+                    [(make_dedup_key(pp, off, geo), make_search_text(pp, off), oid) for oid, pp, off, geo in rows]
+                )
+
+        self.listener = await asyncpg.connect(self.dsn)
+        await self.listener.add_listener('offers_changed', self.on_offers_changed)
+        await self.listener.add_listener('watches_changed', self.on_watches_changed)
+        await self.listener.add_listener('settings_changed', self.on_settings_changed)
+        await self.listener.add_listener('menus_changed', self.on_menus_changed)
+        apply_settings(await self.load_settings())
+
+    async def rebuild_stats(self, conn):
+        async with conn.transaction():
+            await conn.execute('LOCK TABLE offer_stats IN EXCLUSIVE MODE')
+            await conn.execute('DELETE FROM offer_stats')
+            totals = Counter()
+            sql = ("SELECT pp_name, geo, is_active, added_by, to_char(created_at, 'YYYY-MM-DD') FROM offers "
+                   "UNION ALL SELECT pp_name, geo, is_active, added_by, to_char(created_at, 'YYYY-MM-DD') "
+                   "FROM offers_archive")
+            async for row in conn.cursor(sql, prefetch=EXPORT_BATCH_SIZE):
+                count_offer_stats([tuple(row)], totals)
+            await conn.executemany(to_pg_sql(STATS_UPSERT_SQL), stats_rows(totals))
+
+    async def apply_stats(self, conn, deltas):
+        await conn.executemany(to_pg_sql(STATS_UPSERT_SQL), stats_rows(deltas))
+
+    async def close(self):
+        if self.listener:
+            await self.listener.close()
+        if self.pool:
+            await self.pool.close()
+
+    async def fetch(self, sql, params=()):
+        async with self.pool.acquire() as conn:
+            return [tuple(r) for r in await conn.fetch(to_pg_sql(sql), *params)]
+
+    async def fetchrow(self, sql, *params):
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow(sql, *params)
+        return tuple(row) if row else None
+
+    async def execute(self, sql, *params):
+        async with self.pool.acquire() as conn:
+            return await conn.execute(sql, *params)
+
+    async def notify_offers_changed(self, conn, offer_ids):
+        await conn.execute("SELECT pg_notify('offers_changed', $1 || ':' || id) FROM unnest($2::text[]) id",
+                           self.instance_id, [str(i) for i in offer_ids])
+
+    def on_offers_changed(self, connection, pid, channel, payload):
+        instance_id, offer_id = payload.split(':', 1)
+        if instance_id == self.instance_id:
+            return
+        bump_offers_version()
+        if MEMORY_INDEX:
+            spawn_task(self.refresh_memory_index(int(offer_id)))
+
+    def on_settings_changed(self, connection, pid, channel, payload):
+        if payload != self.instance_id:
+            spawn_task(reload_settings())
+
+    def on_watches_changed(self, connection, pid, channel, payload):
+        if payload != self.instance_id:
+            spawn_task(self.reload_watches())
+
+    def on_menus_changed(self, connection, pid, channel, payload):
+        instance_id, user_id = payload.split(':', 1)
+        if instance_id != self.instance_id:
+            MENU_HASHES.pop(int(user_id), None)
+
+    async def reload_watches(self):
+        try:
+            WATCH_INDEX.load(await self.get_watches())
+        except Exception as e:
+            logging.error(f"Watch Reload Error: {e}")
+
+    async def refresh_memory_index(self, offer_id):
+        try:
+            row = await self.fetchrow('SELECT pp_name, offer_name, geo, rate, details, added_by, is_active '
+                                      'FROM offers WHERE id = $1', offer_id)
+        except Exception as e:
+            logging.error(f"Memory Index Refresh Error: {e}")
+            return
+        if row and row[6]:
+            MEMORY_INDEX.upsert(offer_id, dict(zip(OFFER_FIELDS, row[:5])), row[5])
+        else:
+            MEMORY_INDEX.remove(offer_id)
+
+    async def load_settings(self):
+        return await self.fetch('SELECT key, value FROM settings')
+
+    async def get_settings_version(self):
+        row = await self.fetchrow("SELECT value FROM settings WHERE key = 'settings_version'")
+        return int(row[0]) if row else 0
+
+    async def set_setting(self, key, value):
+        async with self.pool.acquire() as conn, conn.transaction():
+            await conn.execute('INSERT INTO settings (key, value) VALUES ($1, $2) '
+                               'ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value', key, value)
+            version = await conn.fetchval(
+                "INSERT INTO settings (key, value) VALUES ('settings_version', '1') ON CONFLICT (key) "
+                "DO UPDATE SET value = (settings.value::bigint + 1)::text RETURNING value")
+            await conn.execute("SELECT pg_notify('settings_changed', $1)", self.instance_id)
+        return int(version)
+
+    async def maintain(self):
+        await self.execute("VACUUM (ANALYZE)")
+
+    async def claim_job_run(self, name, run_at):
+        status = await self.execute('INSERT INTO job_runs (name, run_at) VALUES ($1, $2) ON CONFLICT (name) '
+                                    'DO UPDATE SET run_at = EXCLUDED.run_at WHERE job_runs.run_at < EXCLUDED.run_at',
+                                    name, run_at)
+        return pg_rowcount(status) > 0
+
+    async def create_invite(self, role, uses):
+        code = uuid.uuid4().hex[:8]
+        await self.execute('INSERT INTO invites (code, role, uses_left) VALUES ($1, $2, $3)', code, role, uses)
+        return code
+
+    async def use_invite(self, code):
+        async with self.pool.acquire() as conn, conn.transaction():
+            row = await conn.fetchrow('UPDATE invites SET uses_left = uses_left - 1 '
+                                      'WHERE code = $1 AND uses_left > 0 RETURNING role, uses_left', code)
+            if not row:
+                return None
+            if row['uses_left'] == 0:
+                await conn.execute('DELETE FROM invites WHERE code = $1', code)
+            return row['role']
+
+    async def cleanup_invites(self, ttl_days):
+        if ttl_days > 0:
+            status = await self.execute(
+                f"DELETE FROM invites WHERE uses_left <= 0 OR created_at < {PG_UTC_NOW} - make_interval(days => $1)",
+                ttl_days)
+        else:
+            status = await self.execute("DELETE FROM invites WHERE uses_left <= 0")
+        return pg_rowcount(status)
+
+    async def get_user_role(self, user_id):
+        if user_id == SUPERADMIN_ID: return ROLE_SUPERADMIN
+        row = await self.fetchrow('SELECT role FROM users WHERE user_id = $1', user_id)
+        return row[0] if row else None
+
+    async def add_user(self, user_id, username, role=ROLE_USER, outbox=()):
+        async with self.pool.acquire() as conn, conn.transaction():
+            await conn.execute('INSERT INTO users (user_id, username, role) VALUES ($1, $2, $3) '
+                               'ON CONFLICT (user_id) DO NOTHING', user_id, username, role)
+            await self.write_outbox(conn, outbox)
+
+    async def update_user_role(self, target_id, new_role, outbox=()):
+        async with self.pool.acquire() as conn, conn.transaction():
+            await conn.execute('UPDATE users SET role = $1 WHERE user_id = $2', new_role, target_id)
+            await self.write_outbox(conn, outbox)
+
+    async def get_users_page(self, role_filter=None, name_filter=None, after_id=None, before_id=None,
+                             limit=USERS_PAGE_SIZE):
+        count_sql, count_params, page_sql, page_params = build_users_page_queries(role_filter, name_filter, after_id,
+                                                                                  before_id, limit)
+        async with self.pool.acquire() as conn, conn.transaction(isolation='repeatable_read', readonly=True):
+            total = await conn.fetchval(to_pg_sql(count_sql), *count_params)
+            rows = [tuple(r) for r in await conn.fetch(to_pg_sql(page_sql), *page_params)]
+            counts = {}
+            ids = [r[0] for r in rows[:limit]]
+            if ids:
+                counts = {r[0]: r[1] for r in await conn.fetch(to_pg_sql(build_users_offer_counts_query(ids)), *ids)}
+        return finish_users_page(rows, total, counts, after_id, before_id, limit)
+
+    async def get_menu_hash(self, user_id):
+        if user_id in MENU_HASHES:
+            return MENU_HASHES[user_id]
+        row = await self.fetchrow('SELECT commands_hash FROM menu_state WHERE user_id = $1', user_id)
+        MENU_HASHES[user_id] = row[0] if row else None
+        return MENU_HASHES[user_id]
+
+    async def set_menu_hash(self, user_id, commands_hash):
+        async with self.pool.acquire() as conn, conn.transaction():
+            await conn.execute('INSERT INTO menu_state (user_id, commands_hash) VALUES ($1, $2) '
+                               'ON CONFLICT (user_id) DO UPDATE SET commands_hash = EXCLUDED.commands_hash',
+                               user_id, commands_hash)
+            await conn.execute("SELECT pg_notify('menus_changed', $1 || ':' || $2)", self.instance_id, str(user_id))
+        MENU_HASHES.setdefault(user_id, commands_hash)
+
+    async def get_menu_targets(self):
+        return await self.fetch('SELECT user_id, role FROM users')
+
+    @staticmethod
+    async def record_history(conn, offer_id, action, changes, user_id):
+        await conn.execute('INSERT INTO offer_history (offer_id, action, changes, user_id) VALUES ($1, $2, $3, $4)',
+                           offer_id, action, dump_changes(changes), user_id)
+
+    @staticmethod
+    async def write_outbox(conn, entries):
+        if entries:
+            await conn.executemany(to_pg_sql(OUTBOX_INSERT_SQL), outbox_rows(entries))
+
+    async def enqueue_outbox(self, entries):
+        async with self.pool.acquire() as conn:
+            await self.write_outbox(conn, entries)
+
+    async def claim_outbox(self, limit=OUTBOX_BATCH_SIZE, lease=OUTBOX_LEASE_SECONDS):
+        now = time.time()
+        rows = await self.fetch(
+            "UPDATE outbox SET next_attempt_at = ? WHERE id IN (SELECT id FROM outbox WHERE status = 'pending' "
+            "AND next_attempt_at <= ? ORDER BY id LIMIT ? FOR UPDATE SKIP LOCKED) RETURNING id, chat_id, text, attempts",
+            (now + lease, now, limit))
+        return sorted(rows)
+
+    async def finish_outbox(self, results):
+        async with self.pool.acquire() as conn:
+            await conn.executemany('UPDATE outbox SET status = $1, attempts = attempts + 1, next_attempt_at = $2, '
+                                   'last_error = $3, done_at = $4 WHERE id = $5', results)
+
+    async def purge_outbox(self, retention_days):
+        status = await self.execute("DELETE FROM outbox WHERE status != 'pending' AND done_at < $1",
+                                    time.time() - retention_days * 86400)
+        return pg_rowcount(status)
+
+    async def add_offer(self, data, user_id, outbox=None):
+        geo = data.get('geo', 'Global')
+        async with self.pool.acquire() as conn, conn.transaction():
+            new_id = await conn.fetchval(
+                'INSERT INTO offers (pp_name, offer_name, geo, rate, details, added_by, dedup_key, search_text) '
+                'VALUES ($1, $2, $3, $4, $5, $6, $7, $8) RETURNING id',
+                data['pp_name'], data['offer_name'], geo, data['rate'], data.get('details', '-'), user_id,
+                make_dedup_key(data['pp_name'], data['offer_name'], geo),
+                make_search_text(data['pp_name'], data['offer_name'])
+            )
+            await self.record_history(conn, new_id, 'add', diff_offer_fields(None, data), user_id)
+            await self.apply_stats(conn, offer_stats_deltas(new=data, added_by=user_id, created_day=utc_day()))
+            if outbox:
+                await self.write_outbox(conn, outbox(new_id, data))
+            await self.notify_offers_changed(conn, [new_id])
+
+        bump_offers_version()
+        if MEMORY_INDEX:
+            MEMORY_INDEX.upsert(new_id, data, user_id)
+        await notify_watchers(new_id, data, user_id)
+        return new_id
+
+    async def update_offer(self, offer_id, data, user_id, role, outbox=None):
+        async with self.pool.acquire() as conn, conn.transaction():
+            check = await conn.fetchrow('SELECT added_by, pp_name, offer_name, geo, rate, details, is_active '
+                                        'FROM offers WHERE id = $1 FOR UPDATE', offer_id)
+            if role == ROLE_MANAGER:
+                if not check:
+                    return False
+                if check[0] != user_id:
+                    return "not_owner"
+
+            status = await conn.execute(
+                'UPDATE offers SET pp_name=$1, offer_name=$2, geo=$3, rate=$4, details=$5, dedup_key=$6, '
+                'search_text=$7 WHERE id=$8',
+                data['pp_name'], data['offer_name'], data.get('geo'), data['rate'], data.get('details'),
+                make_dedup_key(data['pp_name'], data['offer_name'], data.get('geo')),
+                make_search_text(data['pp_name'], data['offer_name']), offer_id
+            )
+            if not pg_rowcount(status):
+                return False
+            changes = diff_offer_fields(dict(zip(OFFER_FIELDS, check[1:6])), data)
+            if changes:
+                await self.record_history(conn, offer_id, 'edit', changes, user_id)
+            if check[6]:
+                await self.apply_stats(conn, offer_stats_deltas(dict(zip(OFFER_FIELDS, check[1:6])), data))
+            if outbox:
+                await self.write_outbox(conn, outbox(offer_id, data))
+            await self.notify_offers_changed(conn, [offer_id])
+
+        bump_offers_version()
+        if MEMORY_INDEX and check[6]:
+            MEMORY_INDEX.upsert(offer_id, data, check[0])
+        await notify_watchers(offer_id, data, user_id, is_update=True)
+        return True
+
+    async def delete_offer(self, offer_id, user_id, role, outbox=None):
+        async with self.pool.acquire() as conn, conn.transaction():
+            row = await conn.fetchrow('SELECT pp_name, offer_name, geo, rate, details, added_by, is_active '
+                                      'FROM offers WHERE id = $1 FOR UPDATE', offer_id)
+            if not row or not row['is_active']:
+                return False
+            if role == ROLE_MANAGER and row['added_by'] != user_id:
+                return "not_owner"
+
+            await conn.execute(f'UPDATE offers SET is_active = 0, archived_at = {PG_UTC_NOW} WHERE id = $1', offer_id)
+            await self.record_history(conn, offer_id, 'del', {'is_active': [1, 0]}, user_id)
+            await self.apply_stats(conn, offer_stats_deltas(old=dict(zip(OFFER_FIELDS, tuple(row)[:5]))))
+            if outbox:
+                await self.write_outbox(conn, outbox(offer_id, dict(zip(OFFER_FIELDS, tuple(row)[:5]))))
+            await self.notify_offers_changed(conn, [offer_id])
+
+        bump_offers_version()
+        if MEMORY_INDEX:
+            MEMORY_INDEX.remove(offer_id)
+        return dict(zip(OFFER_FIELDS, tuple(row)[:5]))
+
+    async def get_offer(self, offer_id):
+        return await self.fetchrow('SELECT pp_name, offer_name, geo, rate, details FROM offers WHERE id = $1', offer_id)
+
+    async def check_offer_ownership(self, offer_id, user_id, role):
+        if role in [ROLE_ADMIN, ROLE_SUPERADMIN]:
+            return True
+        row = await self.fetchrow('SELECT added_by FROM offers WHERE id = $1 '
+                                  'UNION ALL SELECT added_by FROM offers_archive WHERE id = $1', offer_id)
+        return bool(row) and row[0] == user_id
+
+    async def find_duplicate(self, data, exclude_id=None):
+        key = make_dedup_key(data['pp_name'], data['offer_name'], data.get('geo', 'Global'))
+        return await self.fetchrow('SELECT id, added_by FROM offers WHERE dedup_key = $1 AND is_active = 1 AND id != $2 '
+                                   'ORDER BY id DESC LIMIT 1', key, exclude_id or 0)
+
+    async def find_duplicate_groups(self):
+        rows = await self.fetch("SELECT dedup_key, string_agg(id::text, ',') FROM offers "
+                                "WHERE is_active = 1 AND dedup_key IS NOT NULL GROUP BY dedup_key HAVING COUNT(*) > 1")
+        return parse_duplicate_groups(rows)
+
+    async def merge_duplicates(self, user_id, outbox=None):
+        groups = await self.find_duplicate_groups()
+        archived = [(dup_id, keep_id) for _, keep_id, dups in groups for dup_id in dups]
+        if not archived:
+            return 0, 0
+
+        async with self.pool.acquire() as conn, conn.transaction():
+            removed = await conn.fetch(f'UPDATE offers SET is_active = 0, archived_at = {PG_UTC_NOW} '
+                                       'WHERE id = ANY($1::bigint[]) AND is_active = 1 RETURNING pp_name, geo',
+                                       [d for d, _ in archived])
+            deltas = Counter()
+            for pp_name, geo in removed:
+                deltas.update(offer_stats_deltas(old={'pp_name': pp_name, 'geo': geo}))
+            await self.apply_stats(conn, deltas)
+            await conn.executemany(
+                'INSERT INTO offer_history (offer_id, action, changes, user_id) VALUES ($1, $2, $3, $4)',
+                [(d, 'del', dump_changes({'is_active': [1, 0], 'merged_into': [None, k]}), user_id)
+                 for d, k in archived]
+            )
+            if outbox:
+                await self.write_outbox(conn, outbox(len(groups), len(archived)))
+            await self.notify_offers_changed(conn, [d for d, _ in archived])
+
+        bump_offers_version()
+        if MEMORY_INDEX:
+            for dup_id, _ in archived:
+                MEMORY_INDEX.remove(dup_id)
+        return len(groups), len(archived)
+
+    async def get_offer_history(self, offer_id, limit=HISTORY_VIEW_LIMIT):
+        rows = await self.fetch(
+            "SELECT action, changes, user_id, to_char(created_at, 'YYYY-MM-DD HH24:MI:SS') FROM offer_history "
+            "WHERE offer_id = ? ORDER BY id DESC LIMIT ?", (offer_id, limit))
+        return [(action, json.loads(changes or '{}'), uid, created_at) for action, changes, uid, created_at in rows]
+
+    async def compact_history(self, retention_days, batch_size=500):
+        cutoff = f"{PG_UTC_NOW} - make_interval(days => $1)"
+        removed = 0
+        async with self.pool.acquire() as conn, conn.transaction():
+            offer_ids = [r[0] for r in await conn.fetch(
+                f"SELECT offer_id FROM offer_history WHERE created_at < {cutoff} "
+                f"GROUP BY offer_id HAVING COUNT(*) > 1 LIMIT $2", retention_days, batch_size)]
+
+            for offer_id in offer_ids:
+                rows = await conn.fetch(
+                    f"SELECT id, changes FROM offer_history WHERE offer_id = $2 AND created_at < {cutoff} ORDER BY id",
+                    retention_days, offer_id)
+                await conn.execute("UPDATE offer_history SET action = 'compact', changes = $1 WHERE id = $2",
+                                   merge_history_changes(r['changes'] for r in rows), rows[-1]['id'])
+                await conn.execute("DELETE FROM offer_history WHERE id = ANY($1::bigint[])", [r['id'] for r in rows[:-1]])
+                removed += len(rows) - 1
+        return removed
+
+    async def archive_offers_batch(self, after_days, batch_size=ARCHIVE_BATCH_SIZE):
+        status = await self.execute(f"""
+        WITH moved AS (
+            DELETE FROM offers WHERE id IN (
+                SELECT id FROM offers
+                WHERE is_active = 0 AND archived_at < {PG_UTC_NOW} - make_interval(days => $1)
+                ORDER BY id LIMIT $2 FOR UPDATE SKIP LOCKED
+            )
+            RETURNING {ARCHIVE_COLUMNS}, search_text
+        )
+        INSERT INTO offers_archive ({ARCHIVE_COLUMNS}, search_text) SELECT {ARCHIVE_COLUMNS}, search_text FROM moved
+        """, after_days, batch_size)
+        return pg_rowcount(status)
+
+    async def is_offer_active(self, offer_id):
+        row = await self.fetchrow('SELECT is_active FROM offers WHERE id = $1', offer_id)
+        return bool(row and row[0])
+
+    async def add_watch(self, user_id, query):
+        async with self.pool.acquire() as conn, conn.transaction():
+            await conn.execute('SELECT pg_advisory_xact_lock($1)', user_id)
+            count = await conn.fetchval('SELECT COUNT(*) FROM watches WHERE user_id = $1', user_id)
+            if count >= BOT_CONFIG['watch_limit']:
+                return "limit"
+            watch_id = await conn.fetchval('INSERT INTO watches (user_id, query) VALUES ($1, $2) '
+                                           'ON CONFLICT (user_id, query) DO NOTHING RETURNING id', user_id, query)
+            if watch_id:
+                await conn.execute("SELECT pg_notify('watches_changed', $1)", self.instance_id)
+        return watch_id
+
+    async def get_user_watches(self, user_id):
+        return await self.fetch('SELECT id, query FROM watches WHERE user_id = ? ORDER BY id', (user_id,))
+
+    async def delete_watch(self, user_id, watch_id):
+        async with self.pool.acquire() as conn, conn.transaction():
+            status = await conn.execute('DELETE FROM watches WHERE id = $1 AND user_id = $2', watch_id, user_id)
+            if pg_rowcount(status):
+                await conn.execute("SELECT pg_notify('watches_changed', $1)", self.instance_id)
+        return pg_rowcount(status) > 0
+
+    async def get_watches(self):
+        return await self.fetch('SELECT id, user_id, query FROM watches')
+
+    async def get_stats(self, limit=STATS_TOP_LIMIT, days=STATS_DAYS):
+        async with self.pool.acquire() as conn, conn.transaction(isolation='repeatable_read', readonly=True):
+            results = [(name, [tuple(r) for r in await conn.fetch(to_pg_sql(sql), *params)])
+                       for name, sql, params in build_stats_queries(limit, days)]
+            ids = [int(uid) for uid, _ in dict(results)['manager']]
+            names = {}
+            if ids:
+                names = {r[0]: r[1] for r in await conn.fetch(to_pg_sql(build_usernames_query(ids)), *ids)}
+        return finish_stats(results, names)
+
+    async def get_active_offers(self):
+        return await self.fetch('SELECT id, pp_name, offer_name, geo, rate, details, added_by FROM offers '
+                                'WHERE is_active = 1')
+
+    async def search_offers(self, query=None, show_all=False, restrict_to_user_id=None, limit=None):
+        sql, params = build_search_query(query, show_all, restrict_to_user_id, limit)
+        try:
+            rows = await self.fetch(sql, params)
+        except Exception as e:
+            logging.error(f"Search Error: {e}")
+            rows = []
+        total = rows[0][8] if rows else 0
+        return [r[:7] for r in rows], total
+
+    async def fuzzy_search(self, query, show_all=False, restrict_to_user_id=None, limit=20):
+        conditions, params, fuzzy_words = build_fuzzy_filters(query, show_all, restrict_to_user_id)
+        if not fuzzy_words or not self.has_trgm:
+            return [], None
+
+        match = " OR ".join(["? <% o.search_text"] * len(fuzzy_words))
+        rank = " + ".join(["word_similarity(?, o.search_text)"] * len(fuzzy_words))
+        where = "".join(f" AND {c}" for c in conditions)
+        sql = f"""
+        SELECT o.id, o.pp_name, o.offer_name, o.geo, o.rate, o.details, o.is_active
+        FROM {offers_source(show_all, "o", f"{TIER_COLUMNS}, search_text")}
+        WHERE ({match}){where}
+        ORDER BY {rank} DESC, o.id DESC
+        LIMIT ?
+        """
+        try:
+            candidates = await self.fetch(sql, fuzzy_words + params + fuzzy_words + [FUZZY_CANDIDATES])
+        except Exception as e:
+            logging.error(f"Fuzzy Search Error: {e}")
+            candidates = []
+        return rank_fuzzy_candidates(candidates, fuzzy_words, limit)
+
+    async def get_my_offers_page(self, user_id, after_id=None, before_id=None, limit=MY_OFFERS_PAGE_SIZE):
+        sql, params = build_my_offers_query(user_id, after_id, before_id, limit)
+        try:
+            async with self.pool.acquire() as conn, conn.transaction(isolation='repeatable_read', readonly=True):
+                total = await conn.fetchval('SELECT COUNT(*) FROM offers WHERE added_by = $1 AND is_active = 1',
+                                            user_id)
+                rows = [tuple(r) for r in await conn.fetch(to_pg_sql(sql), *params)]
+        except Exception as e:
+            logging.error(f"My Offers Error: {e}")
+            rows, total = [], 0
+
+        has_more = len(rows) > limit
+        return rows[:limit], total, has_more
+
+    async def get_column_types(self, conn):
+        rows = await conn.fetch("SELECT column_name, data_type FROM information_schema.columns "
+                                "WHERE table_name = 'offers' AND table_schema = current_schema()")
+        declared = {r['column_name']: r['data_type'].upper() for r in rows}
+        declared['username'] = 'TEXT'
+        return declared
+
+    async def export_offers(self, query, is_archive_mode, restrict_user_id=None, fmt='xlsx'):
+        sql, params = build_export_query(query, is_archive_mode, restrict_user_id)
+        fname = make_export_fname(fmt)
+        loop = asyncio.get_running_loop()
+
+        started = time.perf_counter()
+        try:
+            async with self.pool.acquire() as conn:
+                declared = await self.get_column_types(conn) if fmt == 'parquet' else None
+                writer = await loop.run_in_executor(None, ExportWriter, fname, fmt, declared)
+                try:
+                    async with conn.transaction(readonly=True):
+                        cursor = await conn.cursor(to_pg_sql(sql), *params)
+                        while True:
+                            batch = await cursor.fetch(EXPORT_BATCH_SIZE)
+                            if not batch: break
+                            await loop.run_in_executor(None, writer.write, [tuple(r) for r in batch])
+                finally:
+                    total = await loop.run_in_executor(None, writer.close)
+        except BaseException:
+            if os.path.exists(fname): os.remove(fname)
+            raise
+        return finish_export_file(fname, total, started, query, is_archive_mode, restrict_user_id, fmt)
+
+
+STORAGE = PostgresStorage(DATABASE_URL) if DB_BACKEND == 'postgres' else SQLiteStorage()
+
+
+class TokenBucket:
+    __slots__ = ('capacity', 'rate', 'tokens', 'updated')
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+def take_throttle_token(user_id, role, command):
+    rule = BOT_CONFIG.get(f"throttle_{command}")
+    multiplier = ROLE_THROTTLE_MULTIPLIER.get(role, 1)
+    if not rule or multiplier is None:
+        return 0
+
+    key = (user_id, command)
+    bucket = THROTTLE_BUCKETS.get(key)
+    if bucket is None:
+        if len(THROTTLE_BUCKETS) >= THROTTLE_BUCKETS_LIMIT:
+            THROTTLE_BUCKETS.pop(next(iter(THROTTLE_BUCKETS)))
+        bucket = THROTTLE_BUCKETS[key] = TokenBucket(rule[0] * multiplier, rule[1] * multiplier)
+    return bucket.take()
+
+
+def parse_command(text):
+    parts = text.split(maxsplit=1)
+    command = parts[0][1:].split('@')[0].lower()
+    args = " ".join(parts[1].lower().split()) if len(parts) > 1 else ""
+    return command, args
+
+
+class ThrottleMiddleware(BaseMiddleware):
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        request = describe_throttled_request(event)
+        if not request:
+            return await handler(event, data)
+
+        user_id = event.from_user.id
+        command, args = request
+
+        wait = take_throttle_token(user_id, data.get('role'), command)
+        if wait:
+            metric_inc('throttled')
+            return await reject_request(event, f"⏳ Слишком часто. Повторите через {int(wait) + 1} сек.")
+
+        if command not in SINGLE_FLIGHT_COMMANDS:
+            return await handler(event, data)
+
+        request_key = (command, args)
+        in_flight = IN_FLIGHT.setdefault(user_id, set())
+        if request_key in in_flight:
+            metric_inc('inflight_coalesced')
+            return await reject_request(event, "⏳ Этот запрос уже выполняется, дождитесь результата.")
+
+        if command in EXPORT_COMMANDS:
+            running_exports = sum(1 for c, _ in in_flight if c in EXPORT_COMMANDS)
+            if running_exports >= BOT_CONFIG['max_concurrent_exports']:
+                metric_inc('inflight_rejected')
+                return await reject_request(event, "⏳ Файл уже генерируется. Дождитесь завершения предыдущей выгрузки.")
+
+        in_flight.add(request_key)
+        try:
+            return await handler(event, data)
+        finally:
+            in_flight.discard(request_key)
+            if not in_flight:
+                IN_FLIGHT.pop(user_id, None)
+
+
+def describe_throttled_request(event):
+    if isinstance(event, Message):
+        return parse_command(event.text) if (event.text or "").startswith("/") else None
+    if isinstance(event, InlineQuery):
+        return 'inline', normalize_query_key(event.query) or ""
+    if isinstance(event, CallbackQuery) and (event.data or "").startswith("my:"):
+        return ('export', 'my') if event.data.startswith("my:x") else ('my_offers', 'page')
+    return None
+
+
+async def reject_request(event, text):
+    if isinstance(event, InlineQuery):
+        return await event.answer([], cache_time=1, is_personal=True)
+    if isinstance(event, CallbackQuery):
+        return await event.answer(text, show_alert=True)
+    return await event.answer(text)
+
+
+def describe_event(event):
+    if isinstance(event, Message):
+        return parse_command(event.text)[0] if (event.text or "").startswith("/") else "message"
+    if isinstance(event, CallbackQuery):
+        return f"callback:{(event.data or '').split(':')[0]}"
+    return type(event).__name__.lower()
+
+
+@functools.lru_cache(maxsize=1)
+def registered_event_names():
+    names = {"message", "callback:dup", "callback:my", "callback:users"}
+    for handler in dp.message.handlers:
+        for flt in handler.filters or []:
+            if isinstance(flt.callback, Command):
+                names.update(c for c in flt.callback.commands if isinstance(c, str))
+    return frozenset(names)
+
+
+class WatchdogMiddleware(BaseMiddleware):
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        task = asyncio.current_task()
+        entry = ACTIVE_HANDLERS[task] = [describe_event(event), time.monotonic(), False]
+        try:
+            return await handler(event, data)
+        finally:
+            ACTIVE_HANDLERS.pop(task, None)
+            elapsed = time.monotonic() - entry[1]
+            metric_observe('handler', elapsed)
+            threshold = BOT_CONFIG['slow_handler_ms']
+            if 0 < threshold <= elapsed * 1000:
+                metric_inc('slow_handlers')
+                name = entry[0] if entry[0] in registered_event_names() else "other"
+                metric_observe(f"slow_{name}", elapsed)
+                if not entry[2]:
+                    user = getattr(event, 'from_user', None)
+                    spawn_task(report_watchdog(
+                        "Медленный обработчик",
+                        f"<code>{html.escape(entry[0])}</code> от {user.id if user else '-'}: {elapsed:.2f} с",
+                        None))
 
 
 class AuthMiddleware(BaseMiddleware):
@@ -580,6 +3340,20 @@ class AuthMiddleware(BaseMiddleware):
             event: TelegramObject,
             data: Dict[str, Any]
     ) -> Any:
+        if isinstance(event, CallbackQuery):
+            role = await STORAGE.get_user_role(event.from_user.id)
+            if not role or role == ROLE_BANNED:
+                return await event.answer("⛔️ Доступ запрещен.", show_alert=True)
+            data['role'] = role
+            return await handler(event, data)
+
+        if isinstance(event, InlineQuery):
+            role = await STORAGE.get_user_role(event.from_user.id)
+            if not role or role == ROLE_BANNED:
+                return await event.answer([], cache_time=60, is_personal=True)
+            data['role'] = role
+            return await handler(event, data)
+
         if not isinstance(event, Message): return await handler(event, data)
 
         user_id = event.from_user.id
@@ -588,7 +3362,7 @@ class AuthMiddleware(BaseMiddleware):
             data['role'] = ROLE_SUPERADMIN
             return await handler(event, data)
 
-        role = get_user_role(user_id)
+        role = await STORAGE.get_user_role(user_id)
 
         if role:
             if role == ROLE_BANNED:
@@ -603,10 +3377,12 @@ class AuthMiddleware(BaseMiddleware):
             args = text.split()
             if len(args) > 1:
                 invite_code = args[1]
-                new_role = check_and_use_invite(invite_code)
+                new_role = await STORAGE.use_invite(invite_code)
 
                 if new_role:
-                    add_user(user_id, event.from_user.username, new_role)
+                    log_text = f"🎫 <b>Активация инвайта!</b>\n👤 {user_link(event.from_user)} зашел как <b>{new_role}</b>."
+                    await STORAGE.add_user(user_id, event.from_user.username, new_role,
+                                           outbox=log_outbox(log_text, event_key(event, 'invite')))
                     await update_command_menu(bot, user_id, new_role)
 
                     icon = "👑" if new_role == ROLE_SUPERADMIN else "👮‍♂️" if new_role == ROLE_ADMIN else "💼" if new_role == ROLE_MANAGER else "👤"
@@ -617,9 +3393,6 @@ class AuthMiddleware(BaseMiddleware):
                         parse_mode="HTML"
                     )
 
-                    user_link = f"<a href='tg://user?id={user_id}'>{event.from_user.full_name}</a>"
-                    await send_log_to_chat(f"🎫 <b>Активация инвайта!</b>\n👤 {user_link} зашел как <b>{new_role}</b>.")
-
                     data['role'] = new_role
                     return await handler(event, data)
                 else:
@@ -710,7 +3483,7 @@ async def cmd_invite(message: Message, role: str):
     links = []
 
     for _ in range(count):
-        code = create_invite_db(target_role, 1)
+        code = await STORAGE.create_invite(target_role, 1)
         links.append(f"{base_url}{code}")
 
     if count == 1:
@@ -745,6 +3518,8 @@ async def cmd_help(message: Message, role: str):
         "• <code>/check 1win</code> — Найти офферы по слову\n"
         "• <code>/check -</code> — Показать последние активные\n"
     )
+    if role != ROLE_MANAGER:
+        section_search += "• <code>/watch BR aviator</code> — Подписка на новые офферы по запросу\n"
     if role == ROLE_MANAGER:
         section_search += "<i>(Поиск ищет только по вашим личным офферам)</i>\n"
     elif role == ROLE_USER:
@@ -762,6 +3537,7 @@ async def cmd_help(message: Message, role: str):
             "• <code>/edit ID</code> — Изменить (получить строку)\n"
             "• <code>/del ID</code> — Удалить в архив\n"
             "• <code>/my_offers</code> — Список моих активных\n"
+            "• <code>/history ID</code> — История изменений оффера\n"
             "• <code>/export -</code> — Скачать Excel-отчет\n\n"
             "📝 <b>Формат добавления:</b>\n"
             "<code>/add ПП - Оффер - Гео - Ставка - Гарант (0 если нет) - Инфо</code>\n"
@@ -774,7 +3550,9 @@ async def cmd_help(message: Message, role: str):
             "👑 <b>Администрирование:</b>\n"
             "• <code>/check_archive -</code> — Поиск по Архиву\n"
             "• <code>/export_archive -</code> — Скачать Архив (Excel)\n"
-            "• <code>/del ID</code> — Удаление любого оффера\n\n"
+            "• <code>/del ID</code> — Удаление любого оффера\n"
+            "• <code>/dedup</code> — Найти и объединить дубли\n"
+            "• <code>/stats</code> — Статистика по гео, ПП и менеджерам (<code>/stats chart</code> — график)\n\n"
             "• <code>/invite manager</code> — Создать инвайт (1 вход)\n"
             "• <code>/invite user 10</code> — Инвайт на 10 входов\n"
         )
@@ -783,11 +3561,15 @@ async def cmd_help(message: Message, role: str):
     if role == ROLE_SUPERADMIN:
         section_super = (
             "⚙️ <b>Системное управление:</b>\n"
-            "• <code>/users</code> — Список всех пользователей\n"
+            "• <code>/users</code> — Список пользователей (<code>/users role:manager</code>, <code>/users @name</code>)\n"
             "• <code>/fire ID</code> — Забанить/Разбанить\n"
             "• <code>/setmanager ID</code> — Назначить Менеджером\n"
             "• <code>/setadmin ID</code> — Назначить Админом\n"
             "• <code>/setlog</code> — Назначить этот чат для Логов\n"
+            "• <code>/config</code> — Настройки и расписание задач\n"
+            "• <code>/metrics</code> — Метрики и время фоновых задач\n"
+            "• <code>/profile 10</code> — cProfile event loop на 10 сек (файл-отчет)\n"
+            "• <code>/memsnap 10</code> — Снимок памяти tracemalloc за 10 сек\n"
         )
 
     text = header + section_search + section_manager + section_admin + section_super
@@ -839,29 +3621,17 @@ async def cmd_add(message: Message, role: str):
             'details': details_db
         }
 
-        new_id = add_offer_db(data, message.from_user.id)
-
-        await message.answer(f"✅ <b>OK!</b> {pp} | {off} (ID: {new_id})", parse_mode="HTML")
+        duplicate = await STORAGE.find_duplicate(data)
+        if duplicate:
+            return await ask_duplicate_action(message, role, data, duplicate[0])
 
+        outbox = None
         if message.chat.type == 'private':
-            user_link = f"<a href='tg://user?id={message.from_user.id}'>{message.from_user.full_name}</a>"
+            outbox = offer_log_outbox(event_key(message, 'add'),
+                                      functools.partial(render_offer_log, "🆕 <b>Новый оффер!</b>", message.from_user))
+        new_id = await STORAGE.add_offer(data, message.from_user.id, outbox=outbox)
 
-            if gar not in ['0', '-', '', 'нет']:
-                details_log = f"✅ Гарант: {gar}\n📝 {com}"
-            else:
-                details_log = f"📝 {com}"
-
-            log_text = (
-                f"🆕 <b>Новый оффер!</b>\n"
-                f"👤 {user_link} (ID {message.from_user.id})\n\n"
-                f"🆔 <code>{new_id}</code>\n"
-                f"🏢 <b>{pp}</b>\n"
-                f"🏷 {off}\n"
-                f"🌍 {normalize_geo(geo)}\n"
-                f"💰 {rate}\n"
-                f"{details_log}"
-            )
-            await send_log_to_chat(log_text)
+        await message.answer(f"✅ <b>OK!</b> {html.escape(pp)} | {html.escape(off)} (ID: {new_id})", parse_mode="HTML")
 
         try:
             safe_log = f"ADD OFFER: {pp} - {off}".encode('utf-8', 'ignore').decode('utf-8')
@@ -874,6 +3644,131 @@ async def cmd_add(message: Message, role: str):
         await message.answer(f"❌ Ошибка: {e}")
 
 
+def format_details_log(details):
+    if " | " in details:
+        part_garant, part_info = details.split(" | ", 1)
+        return f"✅ {part_garant}\n📝 {part_info}"
+    return f"📝 {details}"
+
+
+def render_offer_log(title, from_user, offer_id, data):
+    data = escape_fields(data)
+    return (
+        f"{title}\n"
+        f"👤 {user_link(from_user)} (ID {from_user.id})\n\n"
+        f"🆔 <code>{offer_id}</code>\n"
+        f"🏢 <b>{data['pp_name']}</b>\n"
+        f"🏷 {data['offer_name']}\n"
+        f"🌍 {data['geo']}\n"
+        f"💰 {data['rate']}\n"
+        f"{format_details_log(data['details'])}"
+    )
+
+
+def render_delete_log(from_user, offer_id, data):
+    data = escape_fields(data)
+    return (
+        f"🗑 <b>Удаление оффера!</b>\n"
+        f"👤 {user_link(from_user)}\n\n"
+        f"🆔 <code>{offer_id}</code>\n"
+        f"🏷 {data['pp_name']} | {data['offer_name']}\n"
+        f"🌍 {data['geo']} | 💰 {data['rate']}\n"
+        f"📝 {data['details']}"
+    )
+
+
+def remember_pending_add(data, user_id):
+    now = time.time()
+    for token in [t for t, (_, _, ts) in PENDING_ADDS.items() if now - ts > PENDING_ADD_TTL]:
+        del PENDING_ADDS[token]
+    token = uuid.uuid4().hex[:10]
+    PENDING_ADDS[token] = (data, user_id, now)
+    return token
+
+
+async def ask_duplicate_action(message: Message, role: str, data, duplicate_id):
+    token = remember_pending_add(data, message.from_user.id)
+    safe = escape_fields(data)
+
+    buttons = []
+    if await STORAGE.check_offer_ownership(duplicate_id, message.from_user.id, role):
+        buttons.append([InlineKeyboardButton(text=f"✏️ Обновить ID {duplicate_id}",
+                                             callback_data=f"dup:u:{token}:{duplicate_id}")])
+    buttons.append([InlineKeyboardButton(text="➕ Всё равно добавить", callback_data=f"dup:a:{token}:0")])
+    buttons.append([InlineKeyboardButton(text="✖️ Отмена", callback_data=f"dup:c:{token}:0")])
+
+    await message.answer(
+        f"⚠️ <b>Такой оффер уже есть!</b>\n"
+        f"🆔 <code>{duplicate_id}</code> — {safe['pp_name']} | {safe['offer_name']} | {safe['geo']}\n\n"
+        f"Обновить существующий или добавить новый?",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons)
+    )
+
+
+@dp.callback_query(F.data.startswith("dup:"))
+async def cb_duplicate_action(callback: CallbackQuery, role: str):
+    _, action, token, duplicate_id = callback.data.split(":", 3)
+    pending = PENDING_ADDS.get(token)
+
+    if not pending or pending[1] != callback.from_user.id:
+        return await callback.answer("⌛️ Запрос устарел, отправьте /add заново.", show_alert=True)
+    del PENDING_ADDS[token]
+    data = pending[0]
+
+    if action == "c":
+        await callback.message.edit_text("✖️ Добавление отменено.")
+        return await callback.answer()
+
+    title = "✏️ <b>Изменение оффера!</b>" if action == "u" else "🆕 <b>Новый оффер!</b>"
+    outbox = None
+    if callback.message.chat.type == 'private':
+        outbox = offer_log_outbox(event_key(callback, 'dup'),
+                                  functools.partial(render_offer_log, title, callback.from_user))
+
+    if action == "u":
+        offer_id = int(duplicate_id)
+        result = await STORAGE.update_offer(offer_id, data, callback.from_user.id, role, outbox=outbox)
+        if result != True:
+            return await callback.message.edit_text("⛔️ Не удалось обновить оффер.")
+        await callback.message.edit_text(f"✅ Оффер {offer_id} обновлен!")
+    else:
+        offer_id = await STORAGE.add_offer(data, callback.from_user.id, outbox=outbox)
+        safe = escape_fields(data)
+        await callback.message.edit_text(f"✅ <b>OK!</b> {safe['pp_name']} | {safe['offer_name']} (ID: {offer_id})",
+                                         parse_mode="HTML")
+    await callback.answer()
+
+
+@dp.message(Command("dedup"))
+async def cmd_dedup(message: Message, role: str):
+    if role not in [ROLE_ADMIN, ROLE_SUPERADMIN]: return
+
+    args = message.text.split()
+    if len(args) > 1 and args[1].lower() == "merge":
+        groups, archived = await STORAGE.merge_duplicates(
+            message.from_user.id,
+            outbox=lambda g, a: log_outbox(f"🧹 <b>Очистка дублей</b>: групп {g}, в архив {a}.", event_key(message, 'dedup'))
+        )
+        if not archived:
+            return await message.answer("✅ Дубликатов нет.")
+        return await message.answer(f"🧹 Объединено групп: {groups}. В архив перенесено: {archived}.")
+
+    groups = await STORAGE.find_duplicate_groups()
+    if not groups:
+        return await message.answer("✅ Дубликатов нет.")
+
+    res = []
+    for key, keep_id, dups in groups[:30]:
+        res.append(f"• <code>{keep_id}</code> ← {', '.join(str(d) for d in dups)} | {html.escape(key)}")
+    extra = sum(len(d) for _, _, d in groups)
+    await message.answer(
+        f"🔁 <b>Групп дублей: {len(groups)}</b> (лишних офферов: {extra})\n\n" + "\n".join(res) +
+        "\n\n<i>Оставить новейший и убрать остальные в архив:</i> <code>/dedup merge</code>",
+        parse_mode="HTML"
+    )
+
+
 @dp.message(Command("edit"))
 async def cmd_edit(message: Message, role: str):
     if role not in [ROLE_ADMIN, ROLE_SUPERADMIN, ROLE_MANAGER]:
@@ -888,12 +3783,12 @@ async def cmd_edit(message: Message, role: str):
     except:
         return await message.answer("⚠️ ID должен быть числом.")
 
-    can_touch = check_offer_ownership_db(offer_id, message.from_user.id, role)
+    can_touch = await STORAGE.check_offer_ownership(offer_id, message.from_user.id, role)
     if not can_touch:
         return await message.answer("⛔️ Вы можете редактировать только <b>свои</b> офферы.", parse_mode="HTML")
 
     if len(args) == 2:
-        row = get_offer_by_id(offer_id)
+        row = await STORAGE.get_offer(offer_id)
         if not row: return await message.answer("❌ Оффер не найден.")
 
         details = row[4]
@@ -940,29 +3835,14 @@ async def cmd_edit(message: Message, role: str):
 
     data = {'pp_name': pp, 'offer_name': off, 'geo': normalize_geo(geo), 'rate': rate, 'details': details}
 
-    result = update_offer_db(offer_id, data, message.from_user.id, role)
+    outbox = None
+    if message.chat.type == 'private':
+        outbox = offer_log_outbox(event_key(message, 'edit'),
+                                  functools.partial(render_offer_log, "✏️ <b>Изменение оффера!</b>", message.from_user))
+    result = await STORAGE.update_offer(offer_id, data, message.from_user.id, role, outbox=outbox)
 
     if result == True:
         await message.answer(f"✅ Оффер {offer_id} обновлен!")
-        if message.chat.type == 'private':
-            user_link = f"<a href='tg://user?id={message.from_user.id}'>{message.from_user.full_name}</a>"
-
-            if gar not in ['0', '-', '', 'нет']:
-                details_log = f"✅ Гарант: {gar}\n📝 {com}"
-            else:
-                details_log = f"📝 {com}"
-
-            log_text = (
-                f"✏️ <b>Изменение оффера!</b>\n"
-                f"👤 {user_link}\n\n"
-                f"🆔 <code>{offer_id}</code>\n"
-                f"🏢 <b>{pp}</b>\n"
-                f"🏷 {off}\n"
-                f"🌍 {normalize_geo(geo)}\n"
-                f"💰 {rate}\n"
-                f"{details_log}"
-            )
-            await send_log_to_chat(log_text)
 
     elif result == "not_owner":
         await message.answer("⛔️ Вы можете менять только свои офферы.")
@@ -970,25 +3850,118 @@ async def cmd_edit(message: Message, role: str):
         await message.answer("❌ Оффер не найден.")
 
 
+async def render_my_offers_page(user_id, after_id=None, before_id=None):
+    rows, total, has_more = await STORAGE.get_my_offers_page(user_id, after_id, before_id,
+                                                             limit=BOT_CONFIG['my_offers_page_size'])
+
+    if not rows:
+        return None, None
+
+    header = f"📋 <b>Ваши активные офферы ({total}):</b>\n\n"
+    budget = MESSAGE_LIMIT - visible_len(header)
+    entities = MESSAGE_ENTITY_LIMIT - count_entities(header)
+
+    shown = []
+    for r in rows:
+        r = [html.escape(str(v)) if v is not None else "" for v in r]
+        line = truncate_html(f"🆔<code>{r[0]}</code> <b>{r[1]}</b>: {r[2]} (🌍 {r[3]}) — <b>{r[4]}</b> | {r[5]}", budget)
+        cost = visible_len(line) + (2 if shown else 0)
+        if cost > budget or count_entities(line) > entities:
+            break
+        shown.append((r[0], line))
+        budget -= cost
+        entities -= count_entities(line)
+
+    truncated = len(shown) < len(rows) or has_more
+    if before_id is not None:
+        shown.reverse()
+        has_prev, has_next = truncated, True
+    else:
+        has_prev, has_next = after_id is not None, truncated
+
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"my:p:{shown[0][0]}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"my:n:{shown[-1][0]}"))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        buttons,
+        [InlineKeyboardButton(text="📊 Экспорт этих офферов", callback_data="my:x:0")]
+    ])
+
+    return header + "\n\n".join(line for _, line in shown), keyboard
+
+
 @dp.message(Command("my_offers"))
 async def cmd_my_offers(message: Message, role: str):
     if role not in [ROLE_MANAGER, ROLE_ADMIN, ROLE_SUPERADMIN]: return
 
-    rows = get_my_offers_db(message.from_user.id)
+    text, keyboard = await render_my_offers_page(message.from_user.id)
 
-    if not rows:
+    if not text:
         return await message.answer("📭 Вы еще ничего не добавили.")
 
-    res = []
-    for r in rows:
-        res.append(f"🆔<code>{r[0]}</code> <b>{r[1]}</b>: {r[2]} (🌍 {r[3]}) — <b>{r[4]}</b> | {r[5]}")
+    await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
+
 
-    header = f"📋 <b>Ваши активные офферы ({len(rows)}):</b>\n\n"
-    text = header + "\n\n".join(res)
+@dp.callback_query(F.data.startswith("my:"))
+async def cb_my_offers(callback: CallbackQuery, role: str):
+    if role not in [ROLE_MANAGER, ROLE_ADMIN, ROLE_SUPERADMIN]:
+        return await callback.answer("⛔️", show_alert=True)
 
-    if len(text) > 4000:
-        await message.answer(text[:4000] + "...\n(Список обрезан)", parse_mode="HTML")
+    _, action, cursor_id = callback.data.split(":", 2)
+    user_id = callback.from_user.id
+
+    if action == "x":
+        await callback.answer("⏳")
+        return await create_and_send_excel(callback.message, query=None, is_archive_mode=False,
+                                           restrict_user_id=user_id)
+
+    if action == "p":
+        text, keyboard = await render_my_offers_page(user_id, before_id=int(cursor_id))
     else:
+        text, keyboard = await render_my_offers_page(user_id, after_id=int(cursor_id))
+
+    if not text:
+        return await callback.answer("📭 Больше нет офферов.")
+
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
+    await callback.answer()
+
+
+@dp.message(Command("history"))
+async def cmd_history(message: Message, role: str):
+    if role not in [ROLE_MANAGER, ROLE_ADMIN, ROLE_SUPERADMIN]:
+        return await message.answer("⛔️ У вас нет прав на просмотр истории.")
+
+    args = message.text.split()
+    if len(args) < 2:
+        return await message.answer("⚠️ Пример: <code>/history 123</code>", parse_mode="HTML")
+
+    try:
+        offer_id = int(args[1])
+    except ValueError:
+        return await message.answer("⚠️ ID должен быть числом.")
+
+    if not await STORAGE.check_offer_ownership(offer_id, message.from_user.id, role):
+        return await message.answer("⛔️ История доступна только для <b>своих</b> офферов.", parse_mode="HTML")
+
+    entries = await STORAGE.get_offer_history(offer_id)
+    if not entries:
+        return await message.answer(f"📭 История оффера <code>{offer_id}</code> пуста.", parse_mode="HTML")
+
+    icons = {'add': '🆕', 'edit': '✏️', 'del': '🗑', 'compact': '🗜'}
+    res = []
+    for action, changes, uid, created_at in entries:
+        lines = [f"{icons.get(action, '•')} <b>{action}</b> | {created_at} | 👤 <code>{uid}</code>"]
+        for field, (old_value, new_value) in changes.items():
+            if old_value is None:
+                lines.append(f"   {field}: {html.escape(str(new_value))}")
+            else:
+                lines.append(f"   {field}: {html.escape(str(old_value))} → {html.escape(str(new_value))}")
+        res.append("\n".join(lines))
+
+    for text in pack_messages([f"🕓 <b>История оффера {offer_id}:</b>"] + res):
         await message.answer(text, parse_mode="HTML")
 
 
@@ -1003,13 +3976,17 @@ async def cmd_del(message: Message, role: str):
             return await message.answer("⚠️ Пример: <code>/del 123</code>", parse_mode="HTML")
 
         oid = int(args[1])
-        res = delete_offer_db(oid, message.from_user.id, role)
+        outbox = None
+        if message.chat.type == 'private':
+            outbox = offer_log_outbox(event_key(message, 'del'), functools.partial(render_delete_log, message.from_user))
+        res = await STORAGE.delete_offer(oid, message.from_user.id, role, outbox=outbox)
 
         if res == False:
             await message.answer(f"⚠️ Оффер <code>{oid}</code> не найден.", parse_mode="HTML")
         elif res == "not_owner":
             await message.answer("⛔️ Вы не можете удалять чужие офферы.")
         else:
+            res = escape_fields(res)
             info_text = (
                 f"🗑 <b>Оффер удален в архив:</b>\n\n"
                 f"🆔 <code>{oid}</code>\n"
@@ -1020,18 +3997,6 @@ async def cmd_del(message: Message, role: str):
             )
             await message.answer(info_text, parse_mode="HTML")
 
-            if message.chat.type == 'private':
-                user_link = f"<a href='tg://user?id={message.from_user.id}'>{message.from_user.full_name}</a>"
-                log_text = (
-                    f"🗑 <b>Удаление оффера!</b>\n"
-                    f"👤 {user_link}\n\n"
-                    f"🆔 <code>{oid}</code>\n"
-                    f"🏷 {res['pp_name']} | {res['offer_name']}\n"
-                    f"🌍 {res['geo']} | 💰 {res['rate']}\n"
-                    f"📝 {res['details']}"
-                )
-                await send_log_to_chat(log_text)
-
     except ValueError:
         await message.answer("⚠️ ID должен быть числом.")
     except Exception as e:
@@ -1074,40 +4039,379 @@ async def cmd_export(message: Message, role: str):
 
     if len(parts) == 1:
         cmd = "/export_archive" if is_archive else "/export"
-        return await message.reply(f"⚠️ Формат: <code>{cmd} -</code>", parse_mode="HTML")
+        return await message.reply(
+            f"⚠️ Формат: <code>{cmd} -</code>\n"
+            f"Другие форматы: <code>{cmd} fmt:csv -</code> ({', '.join(EXPORT_FORMATS)})",
+            parse_mode="HTML"
+        )
 
-    q = parts[1].strip()
-    if q in ['-', '.', 'все', 'all']: q = None
+    fmt = 'xlsx'
+    words = []
+    for word in parts[1].split():
+        if word.lower().startswith('fmt:'):
+            fmt = word[4:].lower()
+        else:
+            words.append(word)
+
+    if fmt not in EXPORT_FORMATS:
+        return await message.reply(f"⚠️ Форматы: {', '.join(EXPORT_FORMATS)}")
+
+    q = " ".join(words).strip()
+    if q in ['', '-', '.', 'все', 'all']: q = None
 
     restrict_uid = None
     if role == ROLE_MANAGER:
         restrict_uid = message.from_user.id
 
-    await create_and_send_excel(message, query=q, is_archive_mode=is_archive, restrict_user_id=restrict_uid)
+    await create_and_send_excel(message, query=q, is_archive_mode=is_archive, restrict_user_id=restrict_uid, fmt=fmt)
+
+
+@dp.inline_query()
+async def inline_search(inline_query: InlineQuery, role: str):
+    q = inline_query.query.strip() or None
+    restrict_uid = inline_query.from_user.id if role == ROLE_MANAGER else None
+    rows, _ = await find_offers(q, False, restrict_uid, BOT_CONFIG['search_limit'])
+
+    results = [
+        InlineQueryResultArticle(
+            id=str(r[0]),
+            title=f"{r[1]} | {r[2]}",
+            description=f"🌍 {r[3]} | 💰 {r[4]}",
+            input_message_content=InputTextMessageContent(message_text=render_offer_card(r), parse_mode="HTML")
+        )
+        for r in rows
+    ]
+    await inline_query.answer(results, cache_time=30, is_personal=True)
+
+
+@dp.message(Command("watch"))
+async def cmd_watch(message: Message, role: str):
+    if role not in [ROLE_USER, ROLE_ADMIN, ROLE_SUPERADMIN]:
+        return await message.answer("⛔️ Подписки доступны для поиска по общей базе.")
+
+    args = message.text.split(maxsplit=1)
+    query = normalize_query_key(args[1]) if len(args) > 1 else None
+
+    if query:
+        if not WatchIndex.terms(query):
+            return await message.answer("⚠️ Укажите слова для поиска, например: <code>/watch BR aviator</code>",
+                                        parse_mode="HTML")
+        watch_id = await STORAGE.add_watch(message.from_user.id, query)
+        if watch_id == "limit":
+            return await message.answer(f"⚠️ Максимум подписок: {BOT_CONFIG['watch_limit']}. Удалите лишние через /unwatch.")
+        if not watch_id:
+            return await message.answer("ℹ️ Такая подписка уже есть.")
+        WATCH_INDEX.add(watch_id, message.from_user.id, query)
+        return await message.answer(
+            f"🔔 Подписка <code>{watch_id}</code> создана: <b>{html.escape(query)}</b>\n"
+            f"Бот пришлет новые и измененные офферы по этому запросу.",
+            parse_mode="HTML"
+        )
+
+    watches = await STORAGE.get_user_watches(message.from_user.id)
+    if not watches:
+        return await message.answer(
+            "🔔 <b>Подписок нет.</b>\n"
+            "<code>/watch BR aviator</code> — получать новые офферы по запросу\n"
+            "<code>/unwatch ID</code> — удалить подписку",
+            parse_mode="HTML"
+        )
+    lines = [f"• <code>{watch_id}</code> {html.escape(query)}" for watch_id, query in watches]
+    await message.answer("🔔 <b>Ваши подписки:</b>\n" + "\n".join(lines) + "\n\n<i>Удалить:</i> <code>/unwatch ID</code>",
+                         parse_mode="HTML")
+
+
+@dp.message(Command("unwatch"))
+async def cmd_unwatch(message: Message, role: str):
+    args = message.text.split()
+    try:
+        watch_id = int(args[1])
+    except (IndexError, ValueError):
+        return await message.answer("⚠️ Пример: <code>/unwatch 12</code>", parse_mode="HTML")
+
+    if not await STORAGE.delete_watch(message.from_user.id, watch_id):
+        return await message.answer("❌ Подписка не найдена.")
+    WATCH_INDEX.remove(watch_id)
+    await message.answer(f"🔕 Подписка <code>{watch_id}</code> удалена.", parse_mode="HTML")
+
+
+@dp.message(Command("stats"))
+async def cmd_stats(message: Message, role: str):
+    if role not in [ROLE_ADMIN, ROLE_SUPERADMIN]: return
+
+    try:
+        stats = await STORAGE.get_stats(BOT_CONFIG['stats_top'], BOT_CONFIG['stats_days'])
+    except Exception as e:
+        logging.error(f"Stats Error: {e}")
+        return await message.answer("⚠️ Ошибка при получении статистики.")
+    await message.answer(split_html(render_stats(stats))[0], parse_mode="HTML")
+
+    if message.text.split()[1:2] != ['chart']:
+        return
+    if matplotlib is None:
+        return await message.answer("⚠️ График недоступен (не установлен matplotlib).")
+    started = time.monotonic()
+    try:
+        png = await asyncio.get_running_loop().run_in_executor(CHART_EXECUTOR, render_stats_chart, stats)
+    except Exception as e:
+        logging.error(f"Stats Chart Error: {e}")
+        return await message.answer("⚠️ Не удалось построить график.")
+    metric_observe('stats_chart', time.monotonic() - started)
+    await message.answer_photo(BufferedInputFile(png, filename="stats.png"))
 
 
 @dp.message(Command("config"))
 async def cmd_config(message: Message, role: str):
     if role != ROLE_SUPERADMIN: return
-    await message.answer(f"⚙️ LogChat: {BOT_CONFIG['log_chat_id']}", parse_mode="HTML")
+
+    args = message.text.split(maxsplit=2)
+    if len(args) == 3:
+        key, value = args[1], args[2].strip()
+        if key not in EDITABLE_SETTINGS:
+            return await message.answer(f"⚠️ Ключи: {', '.join(EDITABLE_SETTINGS)}")
+        try:
+            await set_setting(key, value)
+        except ValueError:
+            return await message.answer(f"⚠️ Неверное значение ({SETTING_HINTS[SETTINGS_SCHEMA[key][0]]}).",
+                                        parse_mode="HTML")
+
+    lines = [f"⚙️ LogChat: {BOT_CONFIG['log_chat_id']}"]
+    for key in EDITABLE_SETTINGS:
+        lines.append(f"• {key}: <code>{html.escape(format_setting(key, BOT_CONFIG[key]))}</code>")
+    await message.answer("\n".join(lines), parse_mode="HTML")
+
+
+@dp.message(Command("metrics"))
+async def cmd_metrics(message: Message, role: str):
+    if role != ROLE_SUPERADMIN: return
+    metrics = metrics_snapshot()
+    if not metrics: return await message.answer("📈 Метрик пока нет.")
+
+    lines = ["📈 <b>Метрики</b>"]
+    for name, value in sorted(metrics.items()):
+        if isinstance(value, dict):
+            avg = value['total'] / value['count'] if value['count'] else 0
+            lines.append(f"• {name}: n={value['count']} avg={avg:.3f}s max={value['max']:.3f}s last={value['last']:.3f}s")
+        else:
+            lines.append(f"• {name}: {value}")
+    await message.answer("\n".join(lines), parse_mode="HTML")
+
+
+def parse_profile_seconds(text):
+    args = text.split()[1:]
+    if not args:
+        return PROFILE_DEFAULT_SECONDS
+    try:
+        seconds = float(args[0])
+    except ValueError:
+        return None
+    return min(max(seconds, 1), PROFILE_MAX_SECONDS)
+
+
+async def measure_loop_lag(seconds, interval=LOOP_LAG_INTERVAL):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + seconds
+    lags = []
+    while loop.time() < deadline:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, loop.time() - started - interval))
+    return lags
+
+
+def format_loop_lag(lags):
+    if not lags:
+        return "loop lag: no samples"
+    ordered = sorted(lags)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    return (f"loop lag: n={len(lags)} avg={sum(lags) / len(lags) * 1000:.1f}ms "
+            f"p95={p95 * 1000:.1f}ms max={ordered[-1] * 1000:.1f}ms")
+
+
+def format_task_stats(top=10):
+    tasks = asyncio.all_tasks()
+    names = Counter(getattr(t.get_coro(), '__qualname__', repr(t.get_coro())) for t in tasks)
+    lines = [f"asyncio tasks: {len(tasks)}, send queue: {SEND_QUEUE.qsize()}"]
+    lines.extend(f"  {count:>5}  {name}" for name, count in names.most_common(top))
+    return "\n".join(lines)
+
+
+def build_profile_report(title, seconds, lags, body):
+    return "\n\n".join([f"{title} ({seconds:g}s, {datetime.now():%Y-%m-%d %H:%M:%S})", format_loop_lag(lags),
+                        format_task_stats(), body])
+
+
+async def send_profile_report(message: Message, prefix, report, summary):
+    fname = f"{prefix}-{datetime.now():%Y%m%d-%H%M%S}.txt"
+    await message.answer_document(BufferedInputFile(report.encode('utf-8'), filename=fname),
+                                  caption=truncate_html(summary, 1024), parse_mode="HTML")
+
+
+@dp.message(Command("profile"))
+async def cmd_profile(message: Message, role: str):
+    if role != ROLE_SUPERADMIN: return
+    seconds = parse_profile_seconds(message.text)
+    if seconds is None:
+        return await message.answer(f"⚠️ Формат: <code>/profile [секунды]</code> (до {PROFILE_MAX_SECONDS})",
+                                    parse_mode="HTML")
+    if PROFILE_LOCK.locked():
+        return await message.answer("⏳ Профилирование уже идет.")
+
+    async with PROFILE_LOCK:
+        await message.answer(f"⏱ Профилирую event loop {seconds:g} сек...")
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            return await message.answer(f"⚠️ Профилировщик недоступен: {html.escape(str(e))}")
+        try:
+            lags = await measure_loop_lag(seconds)
+        finally:
+            profiler.disable()
+
+        out = io.StringIO()
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+        stats.sort_stats('tottime').print_stats(PROFILE_TOP)
+        report = build_profile_report("cProfile", seconds, lags, out.getvalue())
+
+    metric_inc('profiles')
+    await send_profile_report(message, "profile", report,
+                              f"⏱ <b>cProfile</b> {seconds:g}s | {html.escape(format_loop_lag(lags))}")
+
+
+@dp.message(Command("memsnap"))
+async def cmd_memsnap(message: Message, role: str):
+    if role != ROLE_SUPERADMIN: return
+    seconds = parse_profile_seconds(message.text)
+    if seconds is None:
+        return await message.answer(f"⚠️ Формат: <code>/memsnap [секунды]</code> (до {PROFILE_MAX_SECONDS})",
+                                    parse_mode="HTML")
+    if PROFILE_LOCK.locked():
+        return await message.answer("⏳ Профилирование уже идет.")
+
+    async with PROFILE_LOCK:
+        await message.answer(f"🧠 Снимаю память {seconds:g} сек...")
+        started_here = not tracemalloc.is_tracing()
+        if started_here:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        try:
+            before = tracemalloc.take_snapshot()
+            lags = await measure_loop_lag(seconds)
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            if started_here:
+                tracemalloc.stop()
+
+        snapshot_filter = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        before, after = before.filter_traces(snapshot_filter), after.filter_traces(snapshot_filter)
+        growth = "\n".join(str(stat) for stat in after.compare_to(before, 'lineno')[:PROFILE_TOP])
+        top = "\n".join(str(stat) for stat in after.statistics('lineno')[:PROFILE_TOP])
+        body = (f"traced: current={format_size(current)} peak={format_size(peak)}\n\n"
+                f"Top growth during window:\n{growth or '-'}\n\nTop allocation sites:\n{top or '-'}")
+        report = build_profile_report("tracemalloc", seconds, lags, body)
+
+    metric_inc('memsnaps')
+    await send_profile_report(message, "memsnap", report,
+                              f"🧠 <b>tracemalloc</b> {seconds:g}s | {format_size(current)} "
+                              f"(peak {format_size(peak)}) | {html.escape(format_loop_lag(lags))}")
 
 
 @dp.message(Command("setlog"))
 async def cmd_setlog(message: Message, role: str):
     if role != ROLE_SUPERADMIN: return
     chat_id = message.chat.id
-    update_setting_db('log_chat_id', chat_id)
+    await set_setting('log_chat_id', chat_id)
     await message.answer(f"✅ Логи будут приходить сюда (ID: {chat_id}).")
 
 
+def parse_users_filter(text):
+    role_filter = None
+    name_filter = None
+    for word in text.split():
+        if word.lower().startswith('role:'):
+            role_filter = word[5:].lower()
+        elif word.startswith('@') and len(word) > 1:
+            name_filter = word[1:]
+    return role_filter, name_filter
+
+
+def pack_users_filter(role_filter, name_filter):
+    parts = []
+    if role_filter: parts.append(f"r={role_filter}")
+    if name_filter: parts.append(f"n={name_filter}")
+    return ";".join(parts)
+
+
+def unpack_users_filter(filter_code):
+    role_filter = None
+    if filter_code.startswith("r="):
+        role_filter, _, filter_code = filter_code[2:].partition(";")
+    name_filter = filter_code[2:] if filter_code.startswith("n=") else None
+    return role_filter or None, name_filter or None
+
+
+def users_page_callback(direction, cursor_id, filter_code):
+    return f"users:{direction}:{cursor_id}:{filter_code}".encode('utf-8')[:64].decode('utf-8', 'ignore')
+
+
+async def render_users_page(role_filter=None, name_filter=None, after_id=None, before_id=None):
+    page, total, has_prev, has_next = await STORAGE.get_users_page(role_filter, name_filter, after_id, before_id,
+                                                                   limit=BOT_CONFIG['users_page_size'])
+
+    if not page:
+        return "👥 Пользователи не найдены.", None
+
+    res = []
+    for uid, uname, urole, offers_count in page:
+        shown_role = ROLE_SUPERADMIN if uid == SUPERADMIN_ID else urole
+        res.append(f"🆔<code>{uid}</code> | {shown_role} | @{uname} | 📦 {offers_count}")
+
+    filter_text = ""
+    if role_filter: filter_text += f" role:{role_filter}"
+    if name_filter: filter_text += f" @{name_filter}"
+    header = f"👥 <b>Пользователи ({total}){filter_text}:</b>\n\n"
+
+    filter_code = pack_users_filter(role_filter, name_filter)
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton(text="⬅️", callback_data=users_page_callback("p", page[0][0], filter_code)))
+    if has_next:
+        buttons.append(InlineKeyboardButton(text="➡️", callback_data=users_page_callback("n", page[-1][0], filter_code)))
+
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    return header + "\n".join(res), keyboard
+
+
 @dp.message(Command("users"))
 async def cmd_users(message: Message, role: str):
     if role != ROLE_SUPERADMIN: return
-    df = get_all_users()
-    if df.empty: return await message.answer("Пусто.")
-    res = [f"🆔{r['user_id']} | {ROLE_SUPERADMIN if r['user_id'] == SUPERADMIN_ID else r['role']} | @{r['username']}" for
-           _, r in df.iterrows()]
-    await message.answer("\n".join(res))
+    args = message.text.split(maxsplit=1)
+    role_filter, name_filter = parse_users_filter(args[1] if len(args) > 1 else "")
+
+    if role_filter and role_filter not in ALL_ROLES:
+        return await message.answer(f"⚠️ Роли: {', '.join(ALL_ROLES)}")
+
+    text, keyboard = await render_users_page(role_filter, name_filter)
+    await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
+
+
+@dp.callback_query(F.data.startswith("users:"))
+async def cb_users_page(callback: CallbackQuery, role: str):
+    if role != ROLE_SUPERADMIN:
+        return await callback.answer("⛔️", show_alert=True)
+
+    _, direction, cursor_id, filter_code = callback.data.split(":", 3)
+    role_filter, name_filter = unpack_users_filter(filter_code)
+
+    if direction == "p":
+        text, keyboard = await render_users_page(role_filter, name_filter, before_id=int(cursor_id))
+    else:
+        text, keyboard = await render_users_page(role_filter, name_filter, after_id=int(cursor_id))
+
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
+    await callback.answer()
 
 
 @dp.message(Command("setmanager"))
@@ -1115,7 +4419,7 @@ async def cmd_setmanager(message: Message, role: str):
     if role != ROLE_SUPERADMIN: return
     try:
         uid = int(message.text.split()[1])
-        update_user_role(uid, ROLE_MANAGER)
+        await STORAGE.update_user_role(uid, ROLE_MANAGER)
         await update_command_menu(bot, uid, ROLE_MANAGER)
         await message.answer(f"✅ {uid} -> MANAGER.")
     except:
@@ -1127,7 +4431,7 @@ async def cmd_setadmin(message: Message, role: str):
     if role != ROLE_SUPERADMIN: return
     try:
         uid = int(message.text.split()[1])
-        update_user_role(uid, ROLE_ADMIN)
+        await STORAGE.update_user_role(uid, ROLE_ADMIN)
         await update_command_menu(bot, uid, ROLE_ADMIN)
         await message.answer(f"✅ {uid} -> ADMIN.")
     except:
@@ -1140,7 +4444,7 @@ async def cmd_setuser(message: Message, role: str):
     try:
         uid = int(message.text.split()[1])
         if uid == SUPERADMIN_ID: return
-        update_user_role(uid, ROLE_USER)
+        await STORAGE.update_user_role(uid, ROLE_USER)
         await update_command_menu(bot, uid, ROLE_USER)
         await message.answer(f"⬇️ {uid} -> USER (Общий поиск).")
     except:
@@ -1154,43 +4458,359 @@ async def cmd_fire(message: Message, role: str):
         uid = int(message.text.split()[1])
         if uid == SUPERADMIN_ID: return await message.answer("🗿 Себя нельзя.")
 
-        cur = get_user_role(uid) or ROLE_USER
+        cur = await STORAGE.get_user_role(uid) or ROLE_USER
         if cur == ROLE_BANNED:
-            update_user_role(uid, ROLE_USER)
+            await STORAGE.update_user_role(uid, ROLE_USER, outbox=[(event_key(message, 'unban'), uid, "✅ Бан снят.")])
             await update_command_menu(bot, uid, ROLE_USER)
             await message.answer(f"😇 {uid} Разбанен.")
-            try:
-                await bot.send_message(uid, "✅ Бан снят.")
-            except:
-                pass
         else:
-            update_user_role(uid, ROLE_BANNED)
-            try:
-                await bot.set_my_commands([], scope=BotCommandScopeChat(chat_id=uid))
-            except:
-                pass
+            await STORAGE.update_user_role(uid, ROLE_BANNED, outbox=[(event_key(message, 'ban'), uid, "⛔️ Вы забанены.")])
+            await update_command_menu(bot, uid, ROLE_BANNED)
             await message.answer(f"💀 {uid} Забанен.")
-            try:
-                await bot.send_message(uid, "⛔️ Вы забанены.")
-            except:
-                pass
     except:
         await message.answer("Ошибка.")
 
 
+def parse_cron_field(field, lo, hi):
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step_text = part.split('/', 1)
+            step = int(step_text)
+        if part == '*':
+            start, end = lo, hi
+        elif '-' in part:
+            start_text, end_text = part.split('-', 1)
+            start, end = int(start_text), int(end_text)
+        else:
+            start = int(part)
+            end = hi if step > 1 else start
+        if start < lo or end > hi or start > end or step < 1:
+            raise ValueError(f"bad cron field: {field}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+@functools.lru_cache(maxsize=64)
+def parse_cron(spec):
+    fields = spec.split()
+    if len(fields) != 5:
+        raise ValueError(f"bad cron spec: {spec}")
+    minute, hour, dom, month, dow = fields
+    dows = frozenset(d % 7 for d in parse_cron_field(dow, 0, 7))
+    return (frozenset(parse_cron_field(minute, 0, 59)), frozenset(parse_cron_field(hour, 0, 23)),
+            frozenset(parse_cron_field(dom, 1, 31)), frozenset(parse_cron_field(month, 1, 12)), dows,
+            not dom.startswith('*'), not dow.startswith('*'))
+
+
+def cron_matches(spec, dt):
+    minutes, hours, doms, months, dows, dom_restricted, dow_restricted = parse_cron(spec)
+    day_ok = dt.day in doms
+    weekday_ok = dt.isoweekday() % 7 in dows
+    if dom_restricted and dow_restricted:
+        day_matches = day_ok or weekday_ok
+    else:
+        day_matches = day_ok and weekday_ok
+    return dt.minute in minutes and dt.hour in hours and dt.month in months and day_matches
+
+
+async def job_invite_cleanup():
+    deleted = await STORAGE.cleanup_invites(BOT_CONFIG['invite_ttl_days'])
+    if deleted:
+        logging.info(f"Invite cleanup: removed {deleted}")
+
+
+async def job_db_maintenance():
+    purged = await STORAGE.purge_outbox(OUTBOX_RETENTION_DAYS)
+    if purged:
+        logging.info(f"Outbox cleanup: removed {purged} delivered messages")
+    await STORAGE.maintain()
+
+
+async def job_history_compaction():
+    removed = await STORAGE.compact_history(BOT_CONFIG['history_retention_days'])
+    if removed:
+        logging.info(f"History compaction: folded {removed} entries")
+
+
+async def job_offer_archiving():
+    after_days = BOT_CONFIG['archive_after_days']
+    if after_days <= 0:
+        return
+
+    moved = 0
+    while True:
+        batch = await STORAGE.archive_offers_batch(after_days)
+        moved += batch
+        if batch < ARCHIVE_BATCH_SIZE: break
+    if moved:
+        metric_inc('offers_archived', moved)
+        logging.info(f"Offer archiving: moved {moved} offers to the cold tier")
+
+
+async def job_daily_export():
+    log_chat_id = BOT_CONFIG['log_chat_id']
+    if log_chat_id == 0:
+        return
+
+    version = OFFERS_VERSION
+    result = await STORAGE.export_offers(None, False, None, 'xlsx')
+    if not result:
+        return
+
+    fname, caption, _ = result
+    try:
+        sent = await bot.send_document(log_chat_id, FSInputFile(fname), caption=f"🕘 Ежедневная выгрузка\n{caption}")
+        cache_export(('xlsx', None, False, None), version, sent.document.file_id, caption)
+    finally:
+        if os.path.exists(fname): os.remove(fname)
+
+
+SCHEDULED_JOBS = {
+    'job_invite_cleanup': job_invite_cleanup,
+    'job_db_maintenance': job_db_maintenance,
+    'job_daily_export': job_daily_export,
+    'job_history_compaction': job_history_compaction,
+    'job_offer_archiving': job_offer_archiving,
+}
+RUNNING_JOBS = set()
+BACKGROUND_TASKS = set()
+
+
+def spawn_task(coro):
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+
+async def run_job(name, job, run_at):
+    if name in RUNNING_JOBS:
+        return
+    RUNNING_JOBS.add(name)
+    started = time.perf_counter()
+    try:
+        if not await STORAGE.claim_job_run(name, run_at):
+            metric_inc(f"{name}_claimed_elsewhere")
+            return
+        await job()
+    except Exception as e:
+        metric_inc(f"{name}_errors")
+        logging.error(f"Job {name} Error: {e}")
+    finally:
+        metric_observe(name, time.perf_counter() - started)
+        RUNNING_JOBS.discard(name)
+
+
+async def report_watchdog(title, details, stack):
+    logging.warning(f"Watchdog: {title}: {details}\n{stack or ''}")
+    if take_throttle_token(0, ROLE_USER, 'watchdog_report'):
+        metric_inc('watchdog_reports_suppressed')
+        return
+    text = f"🐢 <b>{title}</b>\n{details}"
+    if stack:
+        text += f"\n<pre>{html.escape(stack[-WATCHDOG_STACK_LIMIT:])}</pre>"
+    try:
+        await STORAGE.enqueue_outbox(log_outbox(text))
+    except Exception as e:
+        logging.error(f"Watchdog Report Error: {e}")
+
+
+def format_task_stack(task):
+    # Task.print_stack() stops at the outermost coroutine; follow the await chain down to the
+    # frame the handler is actually suspended in.
+    frames = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is None: break
+        frames.append((frame, frame.f_lineno))
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return "".join(traceback.StackSummary.extract(frames).format())
+
+
+def check_slow_handlers():
+    threshold = BOT_CONFIG['slow_handler_ms'] / 1000
+    if threshold <= 0:
+        return
+    now = time.monotonic()
+    for task, entry in list(ACTIVE_HANDLERS.items()):
+        name, started, reported = entry
+        if reported or now - started < threshold:
+            continue
+        entry[2] = True
+        spawn_task(report_watchdog(
+            "Медленный обработчик", f"<code>{html.escape(name)}</code> выполняется дольше {threshold:g} с",
+            format_task_stack(task)))
+
+
+def on_loop_stall(heartbeat, stack):
+    stalled = time.monotonic() - heartbeat
+    metric_inc('loop_stalls')
+    metric_observe('loop_stall', stalled)
+    spawn_task(report_watchdog("Event loop заблокирован", f"Цикл не отвечал {stalled:.2f} с", stack))
+
+
+def loop_stall_monitor(loop):
+    # Runs in its own thread: while the loop is blocked nothing on it can observe the stall,
+    # so the loop thread's stack is captured from here and handed back once the loop resumes.
+    reported_heartbeat = None
+    while not loop.is_closed():
+        time.sleep(WATCHDOG_INTERVAL)
+        threshold = BOT_CONFIG['loop_stall_ms'] / 1000
+        heartbeat = LOOP_WATCHDOG['heartbeat']
+        if threshold <= 0 or heartbeat == reported_heartbeat or time.monotonic() - heartbeat < threshold:
+            continue
+        reported_heartbeat = heartbeat
+        frame = sys._current_frames().get(LOOP_WATCHDOG['thread_id'])
+        stack = "".join(traceback.format_stack(frame)) if frame else ""
+        try:
+            loop.call_soon_threadsafe(on_loop_stall, heartbeat, stack)
+        except RuntimeError:
+            return
+
+
+async def loop_watchdog():
+    loop = asyncio.get_running_loop()
+    LOOP_WATCHDOG['thread_id'] = threading.get_ident()
+    LOOP_WATCHDOG['heartbeat'] = time.monotonic()
+    threading.Thread(target=loop_stall_monitor, args=(loop,), name='loop-watchdog', daemon=True).start()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(WATCHDOG_INTERVAL)
+        LOOP_WATCHDOG['heartbeat'] = time.monotonic()
+        metric_observe('loop_lag', max(0.0, loop.time() - started - WATCHDOG_INTERVAL))
+        check_slow_handlers()
+
+
+async def scheduler_loop():
+    last_minute = None
+    while True:
+        now = datetime.now().replace(second=0, microsecond=0)
+        if now != last_minute:
+            last_minute = now
+            for name, job in SCHEDULED_JOBS.items():
+                spec = BOT_CONFIG[name]
+                if not spec or spec == 'off':
+                    continue
+                try:
+                    if cron_matches(spec, now):
+                        spawn_task(run_job(name, job, now))
+                except ValueError as e:
+                    logging.error(f"Scheduler Error: {e}")
+        await asyncio.sleep(60 - datetime.now().second)
+
+
+BENCH_PP_NAMES = ['1win', 'Pin-Up', 'Mostbet', '1xBet', 'Melbet', 'Vavada', 'BetWinner', 'Leon', 'Авиатор Казино']
+BENCH_OFFER_NAMES = ['Aviator', 'Sweet Bonanza', 'Gates of Olympus', 'Plinko', 'Crazy Time', 'JetX', 'Casino', 'Sport']
+BENCH_QUERIES = ['1win', 'aviator', 'BR aviator', 'aviatr', '1wn', 'авиатор', 'mostbt', 'BR']
+
+
+def populate_bench_db(n_rows):
+    import random
+    rnd = random.Random(42)
+    geos = sorted(set(GEO_MAPPING.values()))
+
+    conn = connect_db()
+    conn.executemany(
+        'INSERT INTO offers (pp_name, offer_name, geo, rate, details, is_active, added_by) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        [(rnd.choice(BENCH_PP_NAMES), f"{rnd.choice(BENCH_OFFER_NAMES)} {i % 997}", rnd.choice(geos),
+          f"{rnd.randint(10, 150)}$", f"Гарант: {rnd.randint(0, 50)} cap | bench", int(rnd.random() > 0.2),
+          rnd.randint(1, 50)) for i in range(n_rows)]
+    )
+    rebuild_trigram_index(conn)
+    conn.commit()
+    conn.close()
+
+
+def check_memory_index_parity(memory_index, queries, restrict_to_user_id=None):
+    mismatches = []
+    for q in queries:
+        expected = search_offers_db(q, restrict_to_user_id=restrict_to_user_id)
+        actual = memory_index.search(q, restrict_to_user_id=restrict_to_user_id)
+        if expected != actual:
+            mismatches.append(q)
+    return mismatches or "ok"
+
+
+def time_call(fn, repeats):
+    timings = []
+    result = None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000, result
+
+
+def run_search_benchmark(n_rows, repeats=5):
+    global DB_NAME
+    DB_NAME = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    init_db()
+
+    started = time.perf_counter()
+    populate_bench_db(n_rows)
+    print(f"bench db: {n_rows} rows in {time.perf_counter() - started:.1f}s ({DB_NAME})")
+
+    memory_index = OfferMemoryIndex()
+    started = time.perf_counter()
+    loaded = memory_index.load(get_active_offers_db())
+    print(f"memory index: {loaded} active offers in {time.perf_counter() - started:.1f}s")
+
+    for q in BENCH_QUERIES:
+        exact_ms, (rows, total) = time_call(lambda: search_offers_db(q, limit=SEARCH_LIMIT_VIEW), repeats)
+        memory_ms, (memory_rows, memory_total) = time_call(
+            lambda: memory_index.search(q, limit=SEARCH_LIMIT_VIEW), repeats)
+        fuzzy_ms, (fuzzy_rows, suggestion) = time_call(lambda: fuzzy_search_offers_db(q), repeats)
+        parity = "ok" if (memory_rows, memory_total) == (rows, total) else "MISMATCH"
+        print(f"{q!r:14} sql {exact_ms:8.2f} ms ({total} rows) | memory {memory_ms:8.2f} ms [{parity}] | "
+              f"fuzzy {fuzzy_ms:8.2f} ms ({len(fuzzy_rows)} rows, {suggestion!r})")
+
+    print(f"parity on manager scope: {check_memory_index_parity(memory_index, BENCH_QUERIES, restrict_to_user_id=7)}")
+
+
 async def main():
     print("🚀 Bot started (v4 with Invites & Logs).")
-    init_db()
+    await STORAGE.init()
     await bot.delete_webhook(drop_pending_updates=True)
+    dp.message.outer_middleware(WatchdogMiddleware())
+    dp.callback_query.outer_middleware(WatchdogMiddleware())
+    dp.inline_query.outer_middleware(WatchdogMiddleware())
     dp.message.outer_middleware(AuthMiddleware())
+    dp.message.outer_middleware(ThrottleMiddleware())
+    dp.callback_query.outer_middleware(AuthMiddleware())
+    dp.callback_query.outer_middleware(ThrottleMiddleware())
+    dp.inline_query.outer_middleware(AuthMiddleware())
+    dp.inline_query.outer_middleware(ThrottleMiddleware())
+    if MEMORY_INDEX:
+        loaded = MEMORY_INDEX.load(await STORAGE.get_active_offers())
+        logging.info(f"Memory index: {loaded} active offers loaded")
+    WATCH_INDEX.load(await STORAGE.get_watches())
+    scheduler_task = asyncio.create_task(scheduler_loop())
+    send_queue_task = asyncio.create_task(send_queue_worker())
+    outbox_task = asyncio.create_task(outbox_dispatcher())
+    watchdog_task = asyncio.create_task(loop_watchdog())
+    settings_task = asyncio.create_task(settings_watcher())
     try:
-        await update_command_menu(bot, SUPERADMIN_ID, ROLE_SUPERADMIN)
-    except:
-        pass
-    await dp.start_polling(bot)
+        resynced = await resync_command_menus()
+        if resynced:
+            logging.info(f"Command menus changed, resync queued for {resynced} users")
+        else:
+            await update_command_menu(bot, SUPERADMIN_ID, ROLE_SUPERADMIN)
+    except Exception as e:
+        logging.error(f"Menu Resync Error: {e}")
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await STORAGE.close()
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        run_search_benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 100000)
+        sys.exit(0)
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -0,0 +1,50 @@
+import importlib.util
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+os.environ.setdefault('API_TOKEN', '123456:TEST-token')
+os.environ.setdefault('SUPERADMIN_ID', '1')
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'offer-bot.py')
+spec = importlib.util.spec_from_file_location('offer_bot', BOT_PATH)
+bot = importlib.util.module_from_spec(spec)
+sys.modules['offer_bot'] = bot
+spec.loader.exec_module(bot)
+
+INVALID_SPECS = ['59 99 * * *', '0 9 32 * *', '0 9 * 13 *', '0 9 * * 8', '0 9 * *', 'x 9 * * *']
+
+
+@pytest.mark.parametrize('cron', INVALID_SPECS)
+def test_invalid_field_rejected_in_any_minute(cron):
+    with pytest.raises(ValueError):
+        bot.parse_setting('job_daily_export', cron)
+    start = datetime(2026, 1, 1)
+    for minute in range(0, 24 * 60, 7):
+        with pytest.raises(ValueError):
+            bot.cron_matches(cron, start + timedelta(minutes=minute))
+
+
+def test_sunday_as_seven():
+    sunday = datetime(2026, 10, 18, 9, 0)
+    assert bot.cron_matches('0 9 * * 7', sunday)
+    assert bot.cron_matches('0 9 * * 0', sunday)
+    assert not bot.cron_matches('0 9 * * 7', sunday + timedelta(days=1))
+
+
+def test_day_of_month_or_day_of_week():
+    monday_5th = datetime(2026, 10, 5, 9, 0)
+    friday_2nd = datetime(2026, 10, 2, 9, 0)
+    tuesday_6th = datetime(2026, 10, 6, 9, 0)
+    assert bot.cron_matches('0 9 2 * 1', monday_5th)
+    assert bot.cron_matches('0 9 2 * 1', friday_2nd)
+    assert not bot.cron_matches('0 9 2 * 1', tuesday_6th)
+    assert not bot.cron_matches('0 9 2 * *', monday_5th)
+    assert bot.cron_matches('0 9 * * 1', monday_5th)
+
+
+def test_valid_spec_accepted():
+    assert bot.parse_setting('job_daily_export', '*/15 4-6 1,15 * 1-5') == '*/15 4-6 1,15 * 1-5'
+    assert bot.parse_setting('job_daily_export', 'off') == 'off'